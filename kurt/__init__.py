@@ -82,6 +82,7 @@ from collections import OrderedDict
 import re
 import os
 import random
+import hashlib
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -229,11 +230,18 @@ class Project(object):
             return self._plugin.name
 
     @classmethod
-    def load(cls, path, format=None):
+    def load(cls, path, format=None, media=True):
         """Load project from file.
 
         Use ``format`` to specify the file format to use.
 
+        Pass ``media=False`` to skip loading images and sounds, if you only
+        need the scripts. Each :class:`Costume` and :class:`Sound` is still
+        there with its name, but its :class:`Image` or :class:`Waveform` is a
+        placeholder: sizes, rates and sample counts are available if the file
+        records them, but trying to get the contents raises
+        :class:`MediaNotLoaded`. Such a project can't be saved.
+
         Path can be a file-like object, in which case format is required.
         Otherwise, can guess the appropriate format from the extension.
 
@@ -243,6 +251,7 @@ class Project(object):
         :param path:   Path or file pointer.
         :param format: :attr:`KurtFileFormat.name` eg. ``"scratch14"``.
                        Overrides the extension.
+        :param media:  Whether to load images and sounds.
 
         :raises: :class:`UnknownFormat` if the extension is unrecognised.
         :raises: :py:class:`ValueError` if the format doesn't exist.
@@ -265,7 +274,10 @@ class Project(object):
         if not plugin:
             raise ValueError, "Unknown format %r" % format
 
-        project = plugin.load(fp)
+        if media:
+            project = plugin.load(fp)
+        else:
+            project = plugin.load(fp, media=False)
         if path_was_string:
             fp.close()
         project.convert(plugin)
@@ -325,7 +337,7 @@ class Project(object):
         self._plugin = kurt.plugin.Kurt.get_plugin(format)
         return list(self._normalize())
 
-    def save(self, path=None, debug=False):
+    def save(self, path=None, debug=False, **options):
         """Save project to file.
 
         :param path: Path or file pointer.
@@ -349,7 +361,12 @@ class Project(object):
                      filename is based on the project's :attr:`name`.
 
         :param debug: If true, return debugging information from the format
-                      plugin instead of the path.
+                      plugin instead of the path. Passed on to the plugin as
+                      ``debug=True``.
+
+        :param options: Keyword options for the format plugin, such as
+                        ``compress_level`` for ``scratch20``. They only apply
+                        to this save.
 
         :raises: :py:class:`ValueError` if there's no path or name.
 
@@ -365,6 +382,7 @@ class Project(object):
         if not p.path:
             raise ValueError, "path is required"
 
+        tmp_path = None
         if isinstance(p.path, basestring):
             # split path
             (folder, filename) = os.path.split(p.path)
@@ -385,23 +403,50 @@ class Project(object):
             filename = name + plugin.extension
             p.path = os.path.join(folder, filename)
 
-            # open
-            fp = open(p.path, "wb")
+            # Write to a temporary file first: media loaded from the original
+            # file may still be read from it while saving.
+            tmp_path = p.path + ".tmp"
+            fp = open(tmp_path, "wb")
         else:
             fp = p.path
-            path = None
 
-        if not plugin:
-            raise ValueError, "must convert project to a format before saving"
-
-        for m in p.convert(plugin):
-            print m
-        result = p._save(fp)
-        if path:
+        try:
+            if not plugin:
+                raise ValueError, \
+                    "must convert project to a format before saving"
+            for m in p.convert(plugin):
+                print m
+            if debug:
+                options["debug"] = True
+            result = p._save(fp, **options)
+        except:
+            if tmp_path:
+                fp.close()
+                os.remove(tmp_path)
+            raise
+        if tmp_path:
             fp.close()
+            self._detach_media(p.path)
+            if os.name == "nt" and os.path.exists(p.path):
+                os.remove(p.path)
+            os.rename(tmp_path, p.path)
         return result if debug else p.path
 
-    def _save(self, fp):
+    def _detach_media(self, path):
+        """Read any media still loaded lazily from the file at ``path`` into
+        memory, so the file can be replaced."""
+        path = os.path.abspath(path)
+        for scriptable in [self.stage] + self.sprites:
+            media = ([c.image for c in scriptable.costumes] +
+                     [s.waveform for s in scriptable.sounds])
+            for m in media:
+                if m and getattr(m._source, "path", None) == path:
+                    m.contents
+                    m._source = None
+
+    def _save(self, fp, **options):
+        if options:
+            return self._plugin.save(fp, self, **options)
         return self._plugin.save(fp, self)
 
     def _normalize(self):
@@ -478,22 +523,21 @@ class Project(object):
                 else:
                     raise
 
-            # convert args
-            args = []
-            for arg in block.args:
-                if isinstance(arg, Block):
-                    arg = convert_block(arg)
-                elif isinstance(arg, list):
-                    arg = map(convert_block, arg)
-                args.append(arg)
-            block.args = args
-
             return block
 
         for scriptable in [self.stage] + self.sprites:
             for script in scriptable.scripts:
                 if isinstance(script, Script):
                     script.blocks = map(convert_block, script.blocks)
+                    # convert args -- walk() descends into the replacements
+                    for (block, parent, index) in script.walk():
+                        args = block.args
+                        for i in xrange(len(args)):
+                            arg = args[i]
+                            if isinstance(arg, Block):
+                                args[i] = convert_block(arg)
+                            elif isinstance(arg, list):
+                                args[i] = map(convert_block, arg)
 
         # workaround unsupported features
         for feature in kurt.plugin.Feature.FEATURES.values():
@@ -506,23 +550,20 @@ class Project(object):
             feature.normalize(self)
 
     def get_broadcasts(self):
-        def get_broadcasts(block):
-            for (arg, insert) in zip(block.args, block.type.inserts):
-                if isinstance(arg, Block):
-                    for b in get_broadcasts(arg):
-                        yield b
-                elif isinstance(arg, list):
-                    for arg_block in arg:
-                        for b in get_broadcasts(arg_block):
-                            yield b
-                elif insert.kind == "broadcast":
-                    yield arg
-
+        inserts_by_type = {}
         for scriptable in [self.stage] + self.sprites:
             for script in scriptable.scripts:
-                for block in script.blocks:
-                    for b in get_broadcasts(block):
-                        yield b
+                if not isinstance(script, Script):
+                    continue
+                for (block, parent, index) in script.walk():
+                    inserts = inserts_by_type.get(block.type)
+                    if inserts is None:
+                        inserts = inserts_by_type[block.type] = \
+                            block.type.inserts
+                    for (arg, insert) in zip(block.args, inserts):
+                        if (insert.kind == "broadcast" and
+                                not isinstance(arg, (Block, list))):
+                            yield arg
 
 
 class UnsupportedFeature(object):
@@ -587,6 +628,20 @@ class VectorImageError(Exception):
     pass
 
 
+class MediaNotLoaded(Exception):
+    """Tried to get the contents of an image or sound from a project loaded
+    with ``media=False``.
+
+    See :attr:`Project.load`.
+
+    """
+    pass
+
+
+def _media_not_loaded():
+    raise MediaNotLoaded("project was loaded with media=False")
+
+
 
 #-- Actors & Scriptables --#
 
@@ -705,10 +760,10 @@ class Scriptable(object):
         """Parse the given code and add it to :attr:`scripts`.
 
         The syntax matches :attr:`Script.stringify()`. See :mod:`kurt.text` for
-        reference.
+        reference. Separate scripts with a blank line to add more than one.
 
         """
-        self.scripts.append(kurt.text.parse(text, self))
+        self.scripts += kurt.text.Parser(self).parse_scripts(text)
 
 
 class Stage(Scriptable):
@@ -1824,23 +1879,62 @@ class Block(object):
 
         self._normalize()
 
+    @classmethod
+    def _from_trusted(cls, block_type, args):
+        """Return a new Block without resolving or normalising anything.
+
+        For format plugins, which have already resolved ``block_type`` to a
+        :class:`BlockType` or :class:`CustomBlockType` and built ``args``
+        with one normalised value per insert -- see :meth:`_normalize_arg`.
+        ``args`` is used as-is, not copied.
+
+        """
+        block = cls.__new__(cls)
+        block.type = block_type
+        block.args = args
+        block.comment = u""
+        return block
+
+    @staticmethod
+    def _normalize_arg(insert, arg):
+        """Return the argument converted to suit the given :class:`Insert`."""
+        if insert.shape in ('number', 'number-menu'):
+            if isinstance(arg, basestring):
+                try:
+                    arg = float(arg)
+                    arg = int(arg) if int(arg) == arg else arg
+                except ValueError:
+                    pass
+        return arg
+
     def _normalize(self):
         self.type = BlockType.get(self.type)
         inserts = list(self.type.inserts)
         args = []
         for arg in self.args:
             insert = inserts.pop(0) if inserts else None
-            if insert and insert.shape in ('number', 'number-menu'):
-                if isinstance(arg, basestring):
-                    try:
-                        arg = float(arg)
-                        arg = int(arg) if int(arg) == arg else arg
-                    except ValueError:
-                        pass
+            if insert:
+                arg = Block._normalize_arg(insert, arg)
             args.append(arg)
         self.args = args
         self.comment = unicode(self.comment)
 
+    def walk(self, post_order=False):
+        """Yield ``(block, parent, index)`` for this block and every block
+        nested inside its arguments, without recursing.
+
+        ``parent`` is the Block whose arguments contain ``block``, and
+        ``index`` is the position of that argument in ``parent.args`` -- so
+        the :class:`Insert` is ``parent.type.inserts[index]``. Both are
+        ``None`` for this block.
+
+        Blocks are yielded in pre-order unless ``post_order`` is true. In
+        pre-order, a block's arguments are only read after it is yielded, so
+        they may be replaced during the loop.
+
+        """
+        return _walk_blocks([self], post_order)
+
     def copy(self):
         """Return a new Block instance with the same attributes."""
         args = []
@@ -1926,6 +2020,13 @@ class Script(object):
         for block in self.blocks:
             block._normalize()
 
+    def walk(self, post_order=False):
+        """Yield ``(block, parent, index)`` for every block in the script,
+        including nested ones. See :meth:`Block.walk`.
+
+        """
+        return _walk_blocks(self.blocks, post_order)
+
     def copy(self):
         """Return a new instance with the same attributes."""
         return self.__class__([b.copy() for b in self.blocks],
@@ -1977,6 +2078,59 @@ class Script(object):
         del self.blocks[index]
 
 
+def _walk_blocks(blocks, post_order=False):
+    """Iterative traversal used by :meth:`Block.walk` and :meth:`Script.walk`.
+
+    A stack of pending blocks is used instead of nested generators, so the
+    cost per block doesn't grow with the depth of the tree.
+
+    """
+    if post_order:
+        for item in _walk_blocks_post_order(blocks):
+            yield item
+        return
+
+    stack = [(block, None, None) for block in reversed(blocks)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        item = pop()
+        yield item
+
+        block = item[0]
+        args = block.args
+        for i in xrange(len(args) - 1, -1, -1):
+            arg = args[i]
+            if isinstance(arg, Block):
+                push((arg, block, i))
+            elif isinstance(arg, list):
+                for arg_block in reversed(arg):
+                    if isinstance(arg_block, Block):
+                        push((arg_block, block, i))
+
+def _walk_blocks_post_order(blocks):
+    # Each block is pushed back with ``expanded`` set, below its children.
+    stack = [(block, None, None, False) for block in reversed(blocks)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        (block, parent, index, expanded) = pop()
+        if expanded:
+            yield (block, parent, index)
+            continue
+        push((block, parent, index, True))
+
+        args = block.args
+        for i in xrange(len(args) - 1, -1, -1):
+            arg = args[i]
+            if isinstance(arg, Block):
+                push((arg, block, i, False))
+            elif isinstance(arg, list):
+                for arg_block in reversed(arg):
+                    if isinstance(arg_block, Block):
+                        push((arg_block, block, i, False))
+
+
 class Comment(object):
     """A free-floating comment in :attr:`Scriptable.scripts`."""
 
@@ -2101,6 +2255,10 @@ class Image(object):
 
         Image.load("path/to/image.jpg")
 
+    Deferring decoding until the pixels are needed::
+
+        Image.deferred(lambda: PIL.Image.new("RGBA", (480, 360)), (480, 360))
+
     Images are immutable. If you want to modify an image, get a
     :class:`PIL.Image.Image` instance from :attr:`pil_image`, modify that, and
     use it to construct a new Image. Modifying images in-place may break
@@ -2118,6 +2276,10 @@ class Image(object):
         self._contents = None
         self._format = None
         self._size = None
+        self._decode = None
+        self._source = None
+        self._md5 = None
+        self._pixels_md5 = None
         if isinstance(contents, PIL.Image.Image):
             self._pil_image = contents
         else:
@@ -2125,26 +2287,59 @@ class Image(object):
             self._format = Image.image_format(format)
 
     def __getstate__(self):
+        if self._decode and self._decode is not _media_not_loaded:
+            self.pil_image # bound methods can't be pickled
+        if self._source:
+            self.contents # nor can archives
+        copy = self.__dict__.copy()
+        copy['_source'] = None
         if isinstance(self._pil_image, PIL.Image.Image):
-            copy = self.__dict__.copy()
             copy['_pil_image'] = {
                 'data': self._pil_image.tobytes(),
                 'size': self._pil_image.size,
                 'mode': self._pil_image.mode}
-            return copy
-        return self.__dict__
+        return copy
 
     def __setstate__(self, data):
         self.__dict__.update(data)
         if self._pil_image:
             self._pil_image = PIL.Image.frombytes(**self._pil_image)
 
+    def __eq__(self, other):
+        return isinstance(other, Image) and (self is other or
+                                             self._key == other._key)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+    @property
+    def _key(self):
+        """What Images are compared by: the MD5 of the file contents, or of
+        the pixels if the image has no file format."""
+        if self._decode is _media_not_loaded and not self._md5:
+            return id(self)
+        if self._md5 or self.format:
+            return self.md5
+        if not self._pixels_md5:
+            pil_image = self.pil_image
+            md5 = hashlib.md5("%s %r " % (pil_image.mode, pil_image.size))
+            md5.update(pil_image.tobytes())
+            self._pixels_md5 = "pixels:" + md5.hexdigest()
+        return self._pixels_md5
+
     # Properties
 
     @property
     def pil_image(self):
         """A :class:`PIL.Image.Image` instance containing the image data."""
         if not self._pil_image:
+            if self._decode:
+                self._pil_image = self._decode()
+                self._decode = None
+                return self._pil_image
             if self._format == "SVG":
                 raise VectorImageError("can't rasterise vector images")
             self._pil_image = PIL.Image.open(StringIO(self.contents))
@@ -2159,10 +2354,12 @@ class Image(object):
                 f = open(self._path, "rb")
                 self._contents = f.read()
                 f.close()
-            elif self._pil_image:
+            elif self._source:
+                self._contents = self._source.read()
+            elif self._pil_image or self._decode:
                 # Write PIL image to string
                 f = StringIO()
-                self._pil_image.save(f, self.format)
+                self.pil_image.save(f, self.format)
                 self._contents = f.getvalue()
         return self._contents
 
@@ -2177,6 +2374,8 @@ class Image(object):
         """
         if self._format:
             return self._format
+        elif self._decode:
+            return None # raw pixels, not an image file
         elif self.pil_image:
             return self.pil_image.format
 
@@ -2189,6 +2388,20 @@ class Image(object):
         """
         return Image.image_extension(self.format)
 
+    @property
+    def md5(self):
+        """The MD5 hex digest of :attr:`contents`.
+
+        Only computed once, since Images are immutable. Format plugins may
+        fill it in when loading, if the file records it.
+
+        Images with the same :attr:`format` and md5 are equal.
+
+        """
+        if not self._md5:
+            self._md5 = hashlib.md5(self.contents).hexdigest()
+        return self._md5
+
     @property
     def size(self):
         """``(width, height)`` in pixels."""
@@ -2221,6 +2434,32 @@ class Image(object):
 
         return image
 
+    @classmethod
+    def deferred(cls, decode, size):
+        """Return an Image which calls ``decode()`` to get its
+        :attr:`pil_image` the first time it's needed.
+
+        :param decode: Function returning a :class:`PIL.Image.Image`.
+        :param size: ``(width, height)`` of the image that ``decode`` will
+                     return, so that :attr:`size` doesn't need to decode it.
+
+        """
+        image = Image(None)
+        image._decode = decode
+        image._size = tuple(size) if size else None
+        return image
+
+    @classmethod
+    def placeholder(cls, size=None, format=None):
+        """Return an Image with no data, for projects loaded with
+        ``media=False``. Getting the image data raises
+        :class:`MediaNotLoaded`.
+
+        """
+        image = Image.deferred(_media_not_loaded, size)
+        image._format = Image.image_format(format)
+        return image
+
     def convert(self, *formats):
         """Return an Image instance with the first matching format.
 
@@ -2395,23 +2634,68 @@ class Waveform(object):
     def __init__(self, contents, rate=None, sample_count=None):
         self._path = None
         self._contents = contents
+        self._decode = None
+        self._source = None
+        self._md5 = None
 
         self._rate = rate
         self._sample_count = sample_count
 
+    def __getstate__(self):
+        if self._source:
+            self.contents # archives can't be pickled
+        copy = self.__dict__.copy()
+        copy['_source'] = None
+        return copy
+
+    def __eq__(self, other):
+        return isinstance(other, Waveform) and (self is other or
+                                                self._key == other._key)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+    @property
+    def _key(self):
+        if self._decode is _media_not_loaded and not self._md5:
+            return id(self)
+        return self.md5
+
     # Properties
 
     @property
     def contents(self):
         """The raw file contents as a string."""
         if not self._contents:
-            if self._path:
+            if self._decode:
+                self._contents = self._decode()
+                self._decode = None
+            elif self._source:
+                self._contents = self._source.read()
+            elif self._path:
                 # Read file into memory so we don't run out of file descriptors
                 f = open(self._path, "rb")
                 self._contents = f.read()
                 f.close()
         return self._contents
 
+    @property
+    def md5(self):
+        """The MD5 hex digest of :attr:`contents`.
+
+        Only computed once, since Waveforms are immutable. Format plugins may
+        fill it in when loading, if the file records it.
+
+        Waveforms with the same md5 are equal.
+
+        """
+        if not self._md5:
+            self._md5 = hashlib.md5(self.contents).hexdigest()
+        return self._md5
+
     @property
     def _wave(self):
         """Return a wave.Wave_read instance from the ``wave`` module."""
@@ -2453,6 +2737,16 @@ class Waveform(object):
         wave._path = path
         return wave
 
+    @classmethod
+    def placeholder(cls, rate=None, sample_count=None):
+        """Return a Waveform with no data, for projects loaded with
+        ``media=False``. Getting the contents raises :class:`MediaNotLoaded`.
+
+        """
+        wave = Waveform(None, rate, sample_count)
+        wave._decode = _media_not_loaded
+        return wave
+
     def save(self, path):
         """Save waveform to file path as a WAV file.
 
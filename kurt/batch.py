@@ -0,0 +1,274 @@
+# Copyright (C) 2012 Tim Radvan
+#
+# This file is part of Kurt.
+#
+# Kurt is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Kurt is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with Kurt. If not, see <http://www.gnu.org/licenses/>.
+
+"""Convert many project files between formats at once.
+
+Used by the ``kurt-convert`` script::
+
+    kurt-convert --format scratch20 projects/ more/*.sb -o converted/
+
+Work is spread over a :mod:`multiprocessing` pool. Each worker process
+imports kurt -- and so builds the block tables -- once, and reuses them for
+every file it converts.
+
+One JSON object is written per line for each file as soon as it is done::
+
+    {"path": "projects/game.sb", "output": "converted/game.sb2",
+     "status": "ok", "seconds": 0.061, "warnings": []}
+
+``status`` is one of ``"ok"``, ``"skipped"`` (the output is already up to
+date) or ``"error"`` (with an ``"error"`` message).
+
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import kurt
+from kurt.plugin import Kurt
+
+
+
+#-- Finding files --#
+
+def find_projects(paths, extensions):
+    """Yield ``(path, root)`` for each project file found in ``paths``.
+
+    Paths may be files, folders (searched recursively) or glob patterns.
+    ``root`` is the folder the path was found in, used to keep the same
+    folder structure for the output files.
+
+    """
+    for pattern in paths:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        for path in sorted(matches):
+            if os.path.isdir(path):
+                for (folder, dirs, filenames) in os.walk(path):
+                    dirs.sort()
+                    for filename in sorted(filenames):
+                        if _has_extension(filename, extensions):
+                            yield (os.path.join(folder, filename), path)
+            elif _has_extension(path, extensions):
+                yield (path, os.path.dirname(path))
+
+def _has_extension(path, extensions):
+    (name, extension) = os.path.splitext(path)
+    return extension.lower() in extensions
+
+def output_path(path, root, plugin, output_folder=None):
+    """Return the path to save ``path`` to with the given plugin.
+
+    If ``output_folder`` is None, the file is saved alongside the original.
+
+    """
+    (name, extension) = os.path.splitext(path)
+    if output_folder is not None:
+        name = os.path.join(output_folder, os.path.relpath(name, root))
+    return name + plugin.extension
+
+def file_hash(path):
+    """Return the MD5 hexdigest of the file contents."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+
+#-- Converting --#
+
+class Job(object):
+    """A single file to convert. Must be pickleable."""
+
+    def __init__(self, path, output, format, force=False, known_hash=None,
+                 use_hash=False):
+        self.path = path
+        self.output = output
+        self.format = format
+        self.force = force
+        self.known_hash = known_hash
+        """Hash of ``path`` when ``output`` was last written, if known."""
+        self.use_hash = use_hash
+
+    def is_up_to_date(self, source_hash=None):
+        if self.force or not os.path.exists(self.output):
+            return False
+        if self.use_hash:
+            return source_hash is not None and source_hash == self.known_hash
+        return os.path.getmtime(self.output) >= os.path.getmtime(self.path)
+
+
+def convert_file(job):
+    """Convert a single file. Returns a result dict.
+
+    Never raises, so that one broken file doesn't stop the batch.
+
+    """
+    result = {
+        "path": job.path,
+        "output": job.output,
+        "status": "ok",
+        "warnings": [],
+    }
+    start = time.time()
+    try:
+        source_hash = file_hash(job.path) if job.use_hash else None
+        if source_hash:
+            result["hash"] = source_hash
+
+        if job.is_up_to_date(source_hash):
+            result["status"] = "skipped"
+        else:
+            project = kurt.Project.load(job.path)
+            warnings = project.convert(job.format)
+            result["warnings"] = [unicode(w) for w in warnings]
+
+            folder = os.path.dirname(job.output)
+            if folder and not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError: # another worker got there first
+                    if not os.path.isdir(folder):
+                        raise
+
+            # Save to a temporary file so an interrupted batch can't leave
+            # behind an output that looks up to date.
+            tmp_path = job.output + ".tmp"
+            try:
+                with open(tmp_path, "wb") as fp:
+                    project._save(fp)
+            except Exception:
+                exc_info = sys.exc_info()
+                try:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                except OSError:
+                    pass # report the error from saving, not this one
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if os.path.exists(job.output): # for Windows
+                os.remove(job.output)
+            os.rename(tmp_path, job.output)
+    except Exception, err:
+        result["status"] = "error"
+        result["error"] = "%s: %s" % (err.__class__.__name__, err)
+        result["traceback"] = traceback.format_exc()
+    result["seconds"] = round(time.time() - start, 4)
+    return result
+
+
+def _init_worker():
+    # Make sure the plugins and block tables are set up before the first file
+    # arrives, instead of paying for it inside the first job's timing.
+    for plugin in Kurt.plugins.values():
+        Kurt.get_plugin(plugin.name)
+
+
+def convert_files(jobs, processes=None):
+    """Convert each :class:`Job` using a pool of worker processes.
+
+    Yields result dicts in the order the files finish.
+
+    :param processes: Number of worker processes. Defaults to the number of
+                      CPUs. If 1, files are converted in this process.
+
+    """
+    if processes == 1:
+        for job in jobs:
+            yield convert_file(job)
+        return
+
+    pool = multiprocessing.Pool(processes, _init_worker)
+    try:
+        for result in pool.imap_unordered(convert_file, jobs, chunksize=1):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+
+#-- Command-line interface --#
+
+def load_manifest(path):
+    if path and os.path.exists(path):
+        with open(path, "rb") as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(path, manifest):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kurt-convert",
+        description="Convert Scratch projects between file formats.")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+        help="project files, folders or glob patterns")
+    parser.add_argument("-f", "--format", required=True,
+        choices=Kurt.plugins.keys(),
+        help="format to convert to")
+    parser.add_argument("-o", "--output", metavar="FOLDER",
+        help="where to save converted files (default: next to the original)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--force", action="store_true",
+        help="convert files even if the output is up to date")
+    parser.add_argument("--manifest", metavar="FILE",
+        help="compare files by content hash instead of modification time, "
+             "recording hashes in this JSON file")
+    args = parser.parse_args(argv)
+
+    plugin = Kurt.get_plugin(args.format)
+    extensions = set(p.extension for p in Kurt.plugins.values()
+                     if p is not plugin)
+    manifest = load_manifest(args.manifest)
+
+    def make_jobs():
+        for (path, root) in find_projects(args.paths, extensions):
+            output = output_path(path, root, plugin, args.output)
+            yield Job(path, output, plugin.name, args.force,
+                      manifest.get(os.path.abspath(path)),
+                      use_hash=bool(args.manifest))
+
+    failed = 0
+    try:
+        for result in convert_files(make_jobs(), args.jobs):
+            if result["status"] == "error":
+                failed += 1
+            elif "hash" in result:
+                manifest[os.path.abspath(result["path"])] = result["hash"]
+            sys.stdout.write(json.dumps(result) + "\n")
+            sys.stdout.flush()
+    finally:
+        if args.manifest:
+            save_manifest(args.manifest, manifest)
+
+    return 1 if failed else 0
@@ -113,23 +113,34 @@ class KurtPlugin(object):
 
     # Override the following methods in subclass:
 
-    def load(self, fp):
+    def load(self, fp, media=True):
         """Load a project from a file with this format.
 
         :attr:`Project.path` will be set later. :attr:`Project.name` will be
         set to the filename of the path to the file if unset.
 
         :param fp: A file pointer to the file, opened in binary mode.
+        :param media: If False, don't read the images and sounds. Use
+                      :attr:`Image.placeholder` and
+                      :attr:`Waveform.placeholder` for the media instead. Only
+                      passed when False, so plugins which don't take this
+                      argument will still work.
         :returns: :class:`Project`
 
         """
         raise NotImplementedError
 
-    def save(self, fp, project):
+    def save(self, fp, project, **options):
         """Save a project to a file with this format.
 
         :param path: A file pointer to the file, opened in binary mode.
         :param project: a :class:`Project`
+        :param options: Format-specific keyword options given to
+                        :attr:`Project.save`. Only passed if there are any,
+                        so plugins which don't take options will still work.
+                        Includes ``debug=True`` when :attr:`Project.save` was
+                        asked for debugging information.
+        :returns: Debugging information, such as the file's decoded contents.
 
         """
         raise NotImplementedError
@@ -146,6 +157,21 @@ class Kurt(object):
 
     blocks = []
 
+    _blocks_by_command = {}
+    """:attr:`BlockType` for each :attr:`PluginBlockType.command`.
+
+    Built by :attr:`register`. Used by :attr:`block_by_command`.
+
+    """
+
+    _blocks_by_text = {}
+    """List of :attr:`BlockType` for each :attr:`stripped_text
+    <BaseBlockType.stripped_text>`.
+
+    Built by :attr:`register`. Used by :attr:`blocks_by_text`.
+
+    """
+
     @classmethod
     def register(cls, plugin):
         """Register a new :class:`KurtPlugin`.
@@ -184,6 +210,28 @@ class Kurt(object):
                     raise ValueError, "Couldn't match %r" % pbt._match
                 cls.blocks.append(kurt.BlockType(pbt))
 
+        cls._index_blocks()
+
+    @classmethod
+    def _index_blocks(cls):
+        """Rebuild the lookup tables used by :attr:`block_by_command` and
+        :attr:`blocks_by_text`.
+
+        Called by :attr:`register`. Blocks earlier in :attr:`blocks` take
+        precedence, the same as a linear scan.
+
+        """
+        by_command = {}
+        by_text = {}
+        for block in cls.blocks:
+            for pbt in block.conversions:
+                by_command.setdefault(pbt.command, block)
+                matches = by_text.setdefault(pbt.stripped_text, [])
+                if not matches or matches[-1] is not block:
+                    matches.append(block)
+        cls._blocks_by_command = by_command
+        cls._blocks_by_text = by_text
+
     @classmethod
     def get_plugin(cls, name=None, **kwargs):
         """Returns the first format plugin whose attributes match kwargs.
@@ -229,9 +277,7 @@ class Kurt(object):
         Returns None if the block is not found.
 
         """
-        for block in cls.blocks:
-            if block.has_command(command):
-                return block
+        return cls._blocks_by_command.get(command)
 
     @classmethod
     def blocks_by_text(cls, text):
@@ -241,13 +287,7 @@ class Kurt(object):
 
         """
         text = kurt.BlockType._strip_text(text)
-        matches = []
-        for block in cls.blocks:
-            for pbt in block.conversions:
-                if pbt.stripped_text == text:
-                    matches.append(block)
-                    break
-        return matches
+        return list(cls._blocks_by_text.get(text, []))
 
 
 
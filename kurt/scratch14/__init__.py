@@ -19,6 +19,7 @@
 
 import re
 import wave
+from array import array
 from copy import copy
 
 import PIL
@@ -55,28 +56,30 @@ Container.__repr__ = container_repr
 #-- Utils --#
 
 def get_blocks_by_id(this_block):
-    if isinstance(this_block, kurt.Script):
-        for block in this_block.blocks:
-            for b in get_blocks_by_id(block):
-                yield b
-    elif isinstance(this_block, kurt.Block):
-        yield this_block
-        for arg in this_block.args:
-            if isinstance(arg, kurt.Block):
-                for block in get_blocks_by_id(arg):
-                    yield block
-            elif isinstance(arg, list):
-                for block in arg:
-                    for b in get_blocks_by_id(block):
-                        yield b
+    if isinstance(this_block, (kurt.Script, kurt.Block)):
+        for (block, parent, index) in this_block.walk():
+            yield block
 
 def swap_byte_pairs(data):
-    swapped_bytes = ""
-    for i in range(0, len(data), 2):
-        a = data[i:i+1]
-        b = data[i+1:i+2]
-        swapped_bytes += b + a
-    return swapped_bytes
+    """Return a byte string with the bytes of each 16-bit sample swapped.
+
+    A trailing odd byte is left as-is.
+
+    """
+    data = buffer(data)
+    end = len(data) - len(data) % 2
+    samples = array('h', data[:end])
+    samples.byteswap()
+    return samples.tostring() + data[end:]
+
+def swap_byte_pairs_inplace(data):
+    """Swap the bytes of each 16-bit sample in a bytearray in-place.
+
+    A trailing odd byte is left as-is.
+
+    """
+    end = len(data) - len(data) % 2
+    (data[0:end:2], data[1:end:2]) = (data[1:end:2], data[0:end:2])
 
 
 
@@ -90,6 +93,10 @@ class Serializer(object):
 
     def __init__(self, plugin):
         self.plugin = plugin
+        self.media = True
+        self.block_inserts = {}
+        """Caches :attr:`BlockType.inserts` and their normalised defaults for
+        :meth:`load_block`."""
 
     def UserObject(self, class_name, **attrs):
         defaults = self.plugin.user_objects[class_name].defaults.copy()
@@ -97,11 +104,12 @@ class Serializer(object):
         defaults.update(attrs)
         return Container(class_name=class_name, **defaults)
 
-    def load(self, fp):
+    def load(self, fp, media=True):
         self.project = kurt.Project()
+        self.media = media
 
         # parse object table
-        v14_project = scratch_file.parse_stream(fp)
+        v14_project = parse_scratch_file(fp)
         self.info = decode_obj_table(v14_project.info, self.plugin)
         self.stage = decode_obj_table(v14_project.stage, self.plugin)
 
@@ -204,7 +212,7 @@ class Serializer(object):
             info = encode_obj_table(self.info, self.plugin),
             stage = encode_obj_table(self.stage, self.plugin),
         )
-        scratch_file.build_stream(v14_project, fp)
+        build_scratch_file(v14_project, fp)
 
         return v14_project
 
@@ -226,14 +234,21 @@ class Serializer(object):
 
     def load_image(self, v14_image):
         if v14_image:
-            if v14_image.jpegBytes:
+            if not self.media:
+                if v14_image.jpegBytes:
+                    image = kurt.Image.placeholder(
+                            getattr(v14_image, 'size', None), "JPEG")
+                else:
+                    form = v14_image.compositeForm or v14_image.form
+                    image = kurt.Image.placeholder((form.width, form.height))
+            elif v14_image.jpegBytes:
                 image = kurt.Image(v14_image.jpegBytes.value, "JPEG")
                 if hasattr(v14_image, 'size'):
                     image._size = v14_image.size
             else:
                 form = v14_image.compositeForm or v14_image.form
-                pil_image = form.to_array()
-                image = kurt.Image(pil_image)
+                image = kurt.Image.deferred(form.to_array,
+                                            (form.width, form.height))
             return kurt.Costume(v14_image.name, image,
                                 v14_image.rotationCenter)
 
@@ -251,10 +266,12 @@ class Serializer(object):
                 pil_image = pil_image.convert("RGBA")
                 (width, height) = pil_image.size
                 rgba_string = pil_image.tobytes()
+                form = Form.from_string(width, height, rgba_string)
+                form.compress()
 
                 v14_image = self.UserObject("ImageMedia",
                     name = unicode(kurt_costume.name),
-                    form = Form.from_string(width, height, rgba_string),
+                    form = form,
                 )
 
             v14_image.size = kurt_costume.image.size
@@ -262,6 +279,11 @@ class Serializer(object):
             return v14_image
 
     def load_sound(self, v14_sound):
+        if not self.media:
+            return kurt.Sound(v14_sound.name, kurt.Waveform.placeholder(
+                v14_sound.originalSound.originalSamplingRate,
+                v14_sound.originalSound.samplesSize))
+
         contents = StringIO()
         f = wave.open(contents, 'w')
         f.setnframes(v14_sound.originalSound.samplesSize)
@@ -317,9 +339,20 @@ class Serializer(object):
         else:
             command = command
 
+        block_type = kurt.BlockType.get(command)
+
         # recursively load args
+        if block_type not in self.block_inserts:
+            # Normalised here, as Block() would, since the block is built with
+            # Block._from_trusted.
+            self.block_inserts[block_type] = (block_type.inserts,
+                [kurt.Block._normalize_arg(insert, insert.default)
+                 for insert in block_type.inserts])
+        (inserts, defaults) = self.block_inserts[block_type]
+        inserts = list(inserts)
         new_args = []
         for arg in args:
+            insert = inserts.pop(0) if inserts else None
             if isinstance(arg, list):
                 if arg and isinstance(arg[0], Symbol):
                     arg = self.load_block(arg)
@@ -340,8 +373,11 @@ class Serializer(object):
                 arg = "Stage"
             elif getattr(arg, 'class_name', None) == 'ScratchSpriteMorph':
                 arg = arg.name
+            elif insert:
+                arg = kurt.Block._normalize_arg(insert, arg)
             new_args.append(arg)
-        return kurt.Block(command, *new_args)
+        new_args += defaults[len(new_args):]
+        return kurt.Block._from_trusted(block_type, new_args)
 
     def load_script(self, script_array):
         (pos, blocks) = script_array
@@ -680,10 +716,10 @@ class Scratch14Plugin(KurtPlugin):
     serializer_cls = Serializer
     user_objects = make_user_objects(user_objects_by_name)
 
-    def load(self, fp):
-        return self.serializer_cls(self).load(fp)
+    def load(self, fp, media=True):
+        return self.serializer_cls(self).load(fp, media)
 
-    def save(self, fp, project):
+    def save(self, fp, project, debug=False):
         return self.serializer_cls(self).save(fp, project)
 
 
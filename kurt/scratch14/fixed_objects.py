@@ -17,12 +17,14 @@
 
 """Primitive fixed-format objects - eg String, Dictionary."""
 
-import PIL
+import PIL.Image
+import PIL.ImageChops
 
 from array import array # used by Form
 from copy import copy
 import itertools
 import operator
+import struct
 
 from construct import Container, Struct, Embed, Rename
 from construct import PascalString, UBInt32, SBInt32, UBInt16, UBInt8, Bytes
@@ -449,6 +451,128 @@ def get_run_length(ctx):
     except AttributeError:
         return ctx._.run_length
 
+def decode_run_length(bytes_):
+    """Decode the Squeak run-length encoding described by
+    :attr:`Bitmap._length_run_coding` and return the decoded byte string.
+
+    Each run is expanded with a single bytearray operation, rather than
+    creating a Python object for each pixel. Like the construct version, stops
+    at the first incomplete run.
+
+    """
+    data = bytearray(bytes_)
+    end = len(data)
+    out = bytearray()
+    zero_word = bytearray(4)
+
+    def read_int(pos):
+        """Return (value, pos) for the variable-length int at pos, or
+        (None, pos) if there aren't enough bytes left."""
+        if pos >= end:
+            return (None, pos)
+        value = data[pos]
+        if value <= 223:
+            return (value, pos + 1)
+        elif value <= 254:
+            if pos + 2 > end:
+                return (None, pos)
+            return ((value - 224) * 256 + data[pos + 1], pos + 2)
+        else:
+            if pos + 5 > end:
+                return (None, pos)
+            return ((data[pos + 1] << 24 | data[pos + 2] << 16 |
+                     data[pos + 3] << 8 | data[pos + 4]), pos + 5)
+
+    (length, pos) = read_int(0)
+    if length is None:
+        raise ValueError("bitmap data too short")
+
+    while pos < end:
+        (value, pos) = read_int(pos)
+        if value is None:
+            break
+        (run_length, data_code) = divmod(value, 4)
+
+        if data_code == 0:
+            out += zero_word * run_length
+        elif data_code == 1:
+            if pos + 1 > end:
+                break
+            out += data[pos:pos + 1] * (run_length * 4)
+            pos += 1
+        elif data_code == 2:
+            if pos + 4 > end:
+                break
+            out += data[pos:pos + 4] * run_length
+            pos += 4
+        else:
+            count = run_length * 4
+            if pos + count > end:
+                break
+            out += data[pos:pos + count]
+            pos += count
+
+    return str(out)
+
+def encode_run_length(bytes_):
+    """Run-length encode a byte string of 32-bit words using the format read
+    by :attr:`decode_run_length`.
+
+    Repeated words use data code 0 (zero), 1 (four equal bytes) or 2 (any
+    other word). Runs of unrepeated words are stored using data code 3.
+
+    """
+    bytes_ = bytes(bytes_)
+    assert len(bytes_) % 4 == 0
+    words = array('I', bytes_)
+    assert words.itemsize == 4
+    out = bytearray()
+
+    def encode_int(value):
+        if value <= 223:
+            out.append(value)
+        elif value <= 7935:
+            out.append(224 + (value >> 8))
+            out.append(value & 0xff)
+        else:
+            out.append(255)
+            out.extend(struct.pack(">I", value))
+
+    encode_int(len(words))
+
+    pos = 0
+    literal_start = 0
+    # groupby finds the runs of equal words in C.
+    for (word, group) in itertools.groupby(words):
+        count = sum(1 for _ in group)
+        word_bytes = bytes_[pos * 4:pos * 4 + 4]
+        is_fill = word_bytes == word_bytes[0] * 4
+        if count > 1 or (is_fill and literal_start == pos):
+            # Like Squeak, a single word of four equal bytes only gets its own
+            # run if it's not in the middle of unrepeated words.
+            if literal_start < pos:
+                encode_int((pos - literal_start) * 4 + 3)
+                out += bytes_[literal_start * 4:pos * 4]
+
+            if word == 0:
+                encode_int(count * 4)
+            elif is_fill:
+                encode_int(count * 4 + 1)
+                out += word_bytes[0]
+            else:
+                encode_int(count * 4 + 2)
+                out += word_bytes
+            pos += count
+            literal_start = pos
+        else:
+            pos += 1
+
+    if literal_start < pos:
+        encode_int((pos - literal_start) * 4 + 3)
+        out += bytes_[literal_start * 4:pos * 4]
+
+    return str(out)
+
 class Bitmap(FixedObjectByteArray):
     classID = 13
     _construct = Struct("",
@@ -523,6 +647,13 @@ class Bitmap(FixedObjectByteArray):
         The ByteArray decompresses to a sequence of 32-bit values, which are
         stored as a byte string. (The specific encoding depends on Form.depth.)
         """
+        return cls(decode_run_length(bytes_))
+
+    @classmethod
+    def _from_byte_array_construct(cls, bytes_):
+        """Reference implementation of :attr:`from_byte_array`, using
+        :attr:`_length_run_coding`. Much slower.
+        """
         runs = cls._length_run_coding.parse(bytes_)
         pixels = (run.pixels for run in runs.data)
         data = "".join(itertools.chain.from_iterable(pixels))
@@ -531,7 +662,7 @@ class Bitmap(FixedObjectByteArray):
 
     def compress(self):
         """Compress to a ByteArray"""
-        raise NotImplementedError
+        return ByteArray(encode_run_length(self.to_value().items))
 
 
 
@@ -591,7 +722,16 @@ class Form(FixedObject, ContainsRefs):
             self.bits = Bitmap.from_byte_array(self.bits.value)
         assert isinstance(self.bits, Bitmap)
 
+    def compress(self):
+        """Replace :attr:`bits` with a compressed ByteArray, as Scratch does
+        when saving. Reverse of :attr:`built`.
+        """
+        if isinstance(self.bits, Bitmap):
+            self.bits = self.bits.compress()
+        assert isinstance(self.bits, ByteArray)
+
     def to_array(self):
+        self.built()
         pixel_bytes = bytearray(self.bits.value)
 
         if self.depth == 32:
@@ -631,26 +771,64 @@ class Form(FixedObject, ContainsRefs):
             row_indexes = xrange(0, len(wide_argb_array), in_rowlen)
             argb_array = bytearray(b'').join(wide_argb_array[i:i+out_rowlen]
                                               for i in row_indexes)
+        elif self.depth == 16:
+            return self._to_array_16(pixel_bytes)
+
         else:
-            raise NotImplementedError # TODO: depth 16
+            raise NotImplementedError
 
         size = (self.width, self.height)
         return PIL.Image.frombuffer("RGBA", size, buffer(argb_array), "raw",
                                     "ARGB", 0, 1)
 
+    def _to_array_16(self, pixel_bytes):
+        """Each pixel is a big-endian 16-bit value: one unused bit, then five
+        bits each of red, green and blue. Zero is transparent.
+        """
+        # Rows are a whole number of words long, so two pixels at a time.
+        padded_width = self.width + self.width % 2
+        size = (padded_width, self.height)
+        pixel_bytes = pixel_bytes[:padded_width * self.height * 2]
+
+        high_bytes = pixel_bytes[0::2]
+        low_bytes = pixel_bytes[1::2]
+
+        # PIL reads 15-bit color little-endian, so swap each pair of bytes.
+        swapped = bytearray(len(pixel_bytes))
+        swapped[0::2] = low_bytes
+        swapped[1::2] = high_bytes
+        rgb = PIL.Image.frombuffer("RGB", size, buffer(swapped), "raw",
+                                   "BGR;15", 0, 1)
+
+        high = PIL.Image.frombuffer("L", size, buffer(high_bytes), "raw", "L",
+                                    0, 1)
+        low = PIL.Image.frombuffer("L", size, buffer(low_bytes), "raw", "L",
+                                   0, 1)
+        alpha = PIL.ImageChops.lighter(high, low).point(
+                lambda x: 255 if x else 0)
+
+        pil_image = rgb.convert("RGBA")
+        pil_image.putalpha(alpha)
+        if padded_width != self.width:
+            pil_image = pil_image.crop((0, 0, self.width, self.height))
+        return pil_image
+
     @classmethod
     def from_string(cls, width, height, rgba_string):
         """Returns a Form with 32-bit RGBA pixels
         Accepts string containing raw RGBA color values
         """
-        # Convert RGBA string to ARGB
-        raw = ""
-        for i in range(0, len(rgba_string), 4):
-            raw += rgba_string[i+3]   # alpha
-            raw += rgba_string[i:i+3] # rgb
-
         assert len(rgba_string) == width * height * 4
 
+        # Convert RGBA string to ARGB, a channel at a time
+        rgba = bytearray(rgba_string)
+        argb = bytearray(len(rgba))
+        argb[0::4] = rgba[3::4] # alpha
+        argb[1::4] = rgba[0::4] # red
+        argb[2::4] = rgba[1::4] # green
+        argb[3::4] = rgba[2::4] # blue
+        raw = str(argb)
+
         return Form(
             width = width,
             height = height,
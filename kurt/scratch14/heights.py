@@ -28,7 +28,31 @@ import kurt
 
 
 
+_RECURSION_DEPTH = 100
+"""How deeply nested blocks are measured recursively, before switching to
+:meth:`Block.walk`. Recursion is faster for the shallow scripts most projects
+have."""
+
+
 def block_height(block):
+    return _block_height(block, 0)
+
+
+def _block_height(block, depth):
+    """Height of a block nested ``depth`` levels deep."""
+    if depth >= _RECURSION_DEPTH:
+        # Deeply nested: work from the innermost blocks outwards instead, so
+        # that nested blocks don't need recursion.
+        heights = {}
+        for (b, parent, index) in block.walk(post_order=True):
+            heights[id(b)] = _height(b, heights, depth)
+        return heights[id(block)]
+    return _height(block, None, depth)
+
+
+def _height(block, heights, depth):
+    """Height of the block. The heights of the blocks inside it are looked up
+    in ``heights`` if given, or else found recursively."""
     command = block.type.convert("scratch14").command
 
     FIXED = {
@@ -46,7 +70,7 @@ def block_height(block):
 
         for arg in block.args:
             if isinstance(arg, kurt.Block):
-                height = max(height, block_height(arg) + 3)
+                height = max(height, _arg_height(arg, heights, depth) + 3)
 
         if block.type.has_insert('readonly-menu'):
             height += 2
@@ -68,7 +92,7 @@ def block_height(block):
                     d = 11
                 else:
                     d = 10
-                height = max(height, block_height(arg) + d)
+                height = max(height, _arg_height(arg, heights, depth) + d)
 
             elif insert.shape == 'readonly-menu' and arg:
                 has_menu = True
@@ -87,7 +111,8 @@ def block_height(block):
                 arg = args.pop(0) if args else []
                 if insert.shape == 'stack':
                     height += 9
-                    height += stack_height(arg) - 1 if arg else 14
+                    height += (_stack_height(arg, heights, depth) - 1
+                               if arg else 14)
 
                     if done_one_mouth:
                         height += 5
@@ -103,6 +128,17 @@ def stack_height(blocks):
     return sum(map(block_height, blocks)) - (len(blocks) - 1) * 4
 
 
+def _arg_height(block, heights, depth):
+    if heights is None:
+        return _block_height(block, depth + 1)
+    return heights[id(block)]
+
+
+def _stack_height(blocks, heights, depth):
+    return (sum(_arg_height(b, heights, depth) for b in blocks) -
+            (len(blocks) - 1) * 4)
+
+
 def clean_up(scripts):
     """Clean up the given list of scripts in-place so none of the scripts
     overlap.
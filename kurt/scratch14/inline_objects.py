@@ -34,6 +34,8 @@ class Ref(object):
     Found in UserObjects and certain FixedObjects.
 
     """
+    __slots__ = ("index",)
+
     def __init__(self, index):
         """Initialise a reference.
         @param index: the index in the object table that the reference points to
@@ -90,6 +92,7 @@ class LargeIntegerAdapter(Adapter):
 
     def _encode(self, obj, context):
         bytes = []
+        obj = abs(obj) # the sign is given by the classID
         while obj:
             bytes.append(obj & 0xff)
             obj >>= 8
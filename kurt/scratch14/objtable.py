@@ -25,7 +25,10 @@ Otherwise, the main class in this file is ObjTable.
 from construct import *
 from construct.text import Literal
 from functools import partial
+import binascii
 import inspect
+import mmap
+import struct
 
 from inline_objects import field, Ref
 from fixed_objects import *
@@ -246,6 +249,342 @@ scratch_file = Struct("scratch_file",
 
 
 
+#-- Hand-written codec --#
+
+# The constructs above are the reference implementation of the file format.
+# The functions below parse and build exactly the same thing using struct,
+# which is much faster for the many small objects found in a project.
+
+SCRATCH_FILE_HEADER = "ScratchV02"
+OBJ_TABLE_HEADER = "ObjS\x01Stch\x01"
+
+_UBInt32 = struct.Struct(">I")
+_SBInt32 = struct.Struct(">i")
+_SBInt16 = struct.Struct(">h")
+_UBInt16 = struct.Struct(">H")
+_BFloat64 = struct.Struct(">d")
+_Ref = struct.Struct(">BH")
+_Color = struct.Struct(">I")
+_TranslucentColor = struct.Struct(">IB")
+_user_object_header = struct.Struct(">BBB")
+
+
+def _parse_field(data, pos):
+    """Return ``(value, pos)`` for the inline field at ``pos``."""
+    classID = ord(data[pos])
+    pos += 1
+    if classID == 99:
+        (high, low) = _Ref.unpack_from(data, pos)
+        return (Ref(high << 16 | low), pos + 3)
+    elif classID == 1:
+        return (None, pos)
+    elif classID == 2:
+        return (True, pos)
+    elif classID == 3:
+        return (False, pos)
+    elif classID == 5:
+        return (_SBInt16.unpack_from(data, pos)[0], pos + 2)
+    elif classID == 4:
+        return (_SBInt32.unpack_from(data, pos)[0], pos + 4)
+    elif classID == 8:
+        return (_BFloat64.unpack_from(data, pos)[0], pos + 8)
+    elif classID in (6, 7):
+        (length,) = _UBInt16.unpack_from(data, pos)
+        (digits, pos) = _parse_bytes(data, pos + 2, length)
+        value = int(binascii.hexlify(digits[::-1]) or "0", 16)
+        return (-value if classID == 7 else value, pos)
+    raise ValueError("unknown field classID %i" % classID)
+
+def _parse_fields(data, pos, count):
+    # Refs and small values are handled inline, as there are lots of them.
+    values = []
+    append = values.append
+    for i in xrange(count):
+        classID = data[pos]
+        if classID == "c": # 99
+            (high, low) = _Ref.unpack_from(data, pos + 1)
+            append(Ref(high << 16 | low))
+            pos += 4
+        elif classID == "\x01":
+            append(None)
+            pos += 1
+        elif classID == "\x05":
+            append(_SBInt16.unpack_from(data, pos + 1)[0])
+            pos += 3
+        else:
+            (value, pos) = _parse_field(data, pos)
+            append(value)
+    return (values, pos)
+
+def _parse_bytes(data, pos, length):
+    end = pos + length
+    if end > len(data):
+        raise ValueError("unexpected end of file")
+    return (data[pos:end], end)
+
+def _parse_length_and_bytes(data, pos, scale=1):
+    (length,) = _UBInt32.unpack_from(data, pos)
+    return _parse_bytes(data, pos + 4, length * scale)
+
+def _parse_length_and_fields(data, pos):
+    (length,) = _UBInt32.unpack_from(data, pos)
+    return _parse_fields(data, pos + 4, length)
+
+def _parse_dictionary(data, pos):
+    (length,) = _UBInt32.unpack_from(data, pos)
+    (values, pos) = _parse_fields(data, pos + 4, length * 2)
+    return (dict(zip(values[0::2], values[1::2])), pos)
+
+def _parse_color(data, pos):
+    (word,) = _Color.unpack_from(data, pos)
+    rgb = (word >> 20 & 0x3ff, word >> 10 & 0x3ff, word & 0x3ff)
+    return (Color(rgb), pos + 4)
+
+def _parse_translucent_color(data, pos):
+    (word, alpha) = _TranslucentColor.unpack_from(data, pos)
+    rgba = (word >> 20 & 0x3ff, word >> 10 & 0x3ff, word & 0x3ff, alpha)
+    return (TranslucentColor(rgba), pos + 5)
+
+def _parse_form(data, pos, cls=Form, names=("width", "height", "depth",
+        "privateOffset", "bits")):
+    (values, pos) = _parse_fields(data, pos, len(names))
+    return (cls(**dict(zip(names, values))), pos)
+
+def _parse_color_form(data, pos):
+    return _parse_form(data, pos, ColorForm, ("width", "height", "depth",
+        "privateOffset", "bits", "colors"))
+
+def _parse_symbol(data, pos):
+    (length,) = _UBInt32.unpack_from(data, pos)
+    (value, pos) = _parse_bytes(data, pos + 4, length)
+    return (Symbol(value), pos)
+
+def _wrap(parse, cls):
+    def parse_fixed_object(data, pos):
+        (value, pos) = parse(data, pos)
+        return (cls(value), pos)
+    return parse_fixed_object
+
+def _parse_point(data, pos):
+    (values, pos) = _parse_fields(data, pos, 2)
+    return (Point(*values), pos)
+
+def _parse_rectangle(data, pos):
+    (values, pos) = _parse_fields(data, pos, 4)
+    return (Rectangle(values), pos)
+
+"""Functions parsing each FixedObject, by classID. Like :class:`PythonicAdapter`,
+Strings, UTF8s, Dictionaries and Arrays are returned as native Python types.
+"""
+_fixed_object_parsers = {
+    String.classID: _parse_length_and_bytes,
+    Symbol.classID: _parse_symbol,
+    ByteArray.classID: _wrap(_parse_length_and_bytes, ByteArray),
+    SoundBuffer.classID: _wrap(partial(_parse_length_and_bytes, scale=2),
+                               SoundBuffer),
+    Bitmap.classID: _wrap(partial(_parse_length_and_bytes, scale=4), Bitmap),
+    UTF8.classID: _wrap(_parse_length_and_bytes,
+                        lambda value: value.decode("utf8")),
+
+    Array.classID: _parse_length_and_fields,
+    OrderedCollection.classID: _wrap(_parse_length_and_fields,
+                                     OrderedCollection),
+    Set.classID: _wrap(_parse_length_and_fields, Set),
+    IdentitySet.classID: _wrap(_parse_length_and_fields, IdentitySet),
+    Dictionary.classID: _parse_dictionary,
+    IdentityDictionary.classID: _parse_dictionary,
+
+    Color.classID: _parse_color,
+    TranslucentColor.classID: _parse_translucent_color,
+    Point.classID: _parse_point,
+    Rectangle.classID: _parse_rectangle,
+    Form.classID: _parse_form,
+    ColorForm.classID: _parse_color_form,
+}
+
+def _parse_obj_table_entry(data, pos):
+    classID = ord(data[pos])
+    if classID < 99:
+        parse = _fixed_object_parsers.get(classID)
+        if parse is None:
+            raise ValueError("unknown fixed object classID %i" % classID)
+        return parse(data, pos + 1)
+
+    (classID, version, length) = _user_object_header.unpack_from(data, pos)
+    class_name = user_object_class_ids.get(classID)
+    if class_name is None:
+        raise ValueError("unknown user object classID %i" % classID)
+    (values, pos) = _parse_fields(data, pos + 3, length)
+    return (Container(classID=class_name, version=version, length=length,
+                      values=values), pos)
+
+def parse_obj_table(data, pos=0):
+    """Return ``(entries, pos)`` for the object table in the string ``data``
+    starting at ``pos``.
+
+    Gives the same entries as :attr:`obj_table`.
+
+    """
+    if data[pos:pos + 10] != OBJ_TABLE_HEADER:
+        raise ValueError("object table header not found")
+    try:
+        (length,) = _UBInt32.unpack_from(data, pos + 10)
+        pos += 14
+        entries = []
+        for i in xrange(length):
+            (entry, pos) = _parse_obj_table_entry(data, pos)
+            entries.append(entry)
+    except (struct.error, IndexError):
+        raise ValueError("unexpected end of file")
+    return (entries, pos)
+
+def parse_scratch_file(fp):
+    """Parse a .sb file. Gives the same result as :attr:`scratch_file`."""
+    data = fp.read()
+    if not data.startswith(SCRATCH_FILE_HEADER):
+        raise ValueError("not a Scratch 1.4 file")
+    (info, pos) = parse_obj_table(data, len(SCRATCH_FILE_HEADER) + 4)
+    (stage, pos) = parse_obj_table(data, pos)
+    return Container(info=info, stage=stage)
+
+
+def _build_field(value, append):
+    if value is None:
+        append("\x01")
+    elif value is True:
+        append("\x02")
+    elif value is False:
+        append("\x03")
+    elif isinstance(value, Ref):
+        append("c" + _Ref.pack(value.index >> 16 & 0xff, value.index & 0xffff))
+    elif isinstance(value, float):
+        append("\x08" + _BFloat64.pack(value))
+    elif isinstance(value, (int, long)):
+        if -32768 <= value <= 32767:
+            append("\x05" + _SBInt16.pack(value))
+        elif -2147483648 <= value <= 2147483647:
+            append("\x04" + _SBInt32.pack(value))
+        else:
+            digits = "%x" % abs(value)
+            digits = binascii.unhexlify("0" * (len(digits) % 2) + digits)
+            append(("\x06" if value > 0 else "\x07") +
+                   _UBInt16.pack(len(digits)) + digits[::-1])
+    else:
+        raise NotImplementedError, 'no field type for %r' % value
+
+def _build_fields(values, append):
+    for value in values:
+        _build_field(value, append)
+
+def _build_length_and_bytes(obj, append):
+    append(_UBInt32.pack(len(obj.value)))
+    append(obj.value)
+
+def _build_length_and_items(obj, append):
+    value = obj.to_value()
+    append(_UBInt32.pack(value.length))
+    append(value.items)
+
+def _build_utf8(obj, append):
+    value = obj.value.encode("utf8")
+    append(_UBInt32.pack(len(value)))
+    append(value)
+
+def _build_collection(obj, append):
+    append(_UBInt32.pack(len(obj.value)))
+    _build_fields(obj.value, append)
+
+def _build_dictionary(obj, append):
+    items = dict(obj.value).items()
+    append(_UBInt32.pack(len(items)))
+    for (key, value) in items:
+        _build_field(key, append)
+        _build_field(value, append)
+
+def _build_color(obj, append):
+    (r, g, b) = obj.value
+    append(_Color.pack((r & 0x3ff) << 20 | (g & 0x3ff) << 10 | (b & 0x3ff)))
+
+def _build_translucent_color(obj, append):
+    (r, g, b, alpha) = obj.value
+    append(_TranslucentColor.pack(
+        (r & 0x3ff) << 20 | (g & 0x3ff) << 10 | (b & 0x3ff), alpha))
+
+def _build_point(obj, append):
+    _build_fields((obj.x, obj.y), append)
+
+def _build_rectangle(obj, append):
+    if len(obj.value) != 4:
+        raise ValueError("Rectangle needs 4 values, not %i" % len(obj.value))
+    _build_fields(obj.value, append)
+
+def _build_form(obj, append):
+    _build_fields((obj.width, obj.height, obj.depth, obj.privateOffset,
+                   obj.bits), append)
+
+def _build_color_form(obj, append):
+    _build_form(obj, append)
+    _build_field(obj.colors, append)
+
+"""Functions building each FixedObject, by classID."""
+_fixed_object_builders = {
+    String.classID: _build_length_and_bytes,
+    Symbol.classID: _build_length_and_bytes,
+    ByteArray.classID: _build_length_and_bytes,
+    SoundBuffer.classID: _build_length_and_items,
+    Bitmap.classID: _build_length_and_items,
+    UTF8.classID: _build_utf8,
+
+    Array.classID: _build_collection,
+    OrderedCollection.classID: _build_collection,
+    Set.classID: _build_collection,
+    IdentitySet.classID: _build_collection,
+    Dictionary.classID: _build_dictionary,
+    IdentityDictionary.classID: _build_dictionary,
+
+    Color.classID: _build_color,
+    TranslucentColor.classID: _build_translucent_color,
+    Point.classID: _build_point,
+    Rectangle.classID: _build_rectangle,
+    Form.classID: _build_form,
+    ColorForm.classID: _build_color_form,
+}
+
+_pythonic = PythonicAdapter(Pass)
+
+def build_obj_table(entries):
+    """Return the object table for the list of entries as a string.
+
+    Gives the same bytes as :attr:`obj_table`.
+
+    """
+    chunks = [OBJ_TABLE_HEADER, _UBInt32.pack(len(entries))]
+    append = chunks.append
+    for entry in entries:
+        if isinstance(entry, Container):
+            if len(entry.values) != entry.length:
+                raise ValueError("%s has %i values, expected %i" % (
+                    entry.classID, len(entry.values), entry.length))
+            append(_user_object_header.pack(
+                user_object_ids_by_name[entry.classID],
+                entry.version, entry.length))
+            _build_fields(entry.values, append)
+        else:
+            entry = _pythonic._encode(entry, None)
+            append(chr(entry.classID))
+            _fixed_object_builders[entry.classID](entry, append)
+    return "".join(chunks)
+
+def build_scratch_file(v14_project, fp):
+    """Write a .sb file. Gives the same bytes as :attr:`scratch_file`."""
+    info = build_obj_table(v14_project.info)
+    fp.write(SCRATCH_FILE_HEADER)
+    fp.write(_UBInt32.pack(len(info)))
+    fp.write(info)
+    fp.write(build_obj_table(v14_project.stage))
+
+
+
 #-- object network to/from table --#
 
 def decode_network(objects):
@@ -290,9 +629,8 @@ def decode_network(objects):
 
         objects[i] = obj
 
-    for obj in objects:
-        if isinstance(obj, Form):
-            obj.built()
+    # Forms are left compressed until their pixels are needed. See
+    # Form.to_array.
 
     root = objects[0]
     return root
@@ -307,7 +645,7 @@ def encode_network(root):
         adding it if needed.
 
         """
-        value = PythonicAdapter(Pass)._encode(value, None)
+        value = _pythonic._encode(value, None)
         # Convert strs to FixedObjects here to make sure they get encoded
         # correctly
 
@@ -325,7 +663,7 @@ def encode_network(root):
             return value # Inline value
 
     def fix_fields(obj):
-        obj = PythonicAdapter(Pass)._encode(obj, None)
+        obj = _pythonic._encode(obj, None)
         # Convert strs to FixedObjects here to make sure they get encoded
         # correctly
 
@@ -365,7 +703,7 @@ def encode_network(root):
         fixed_obj._made_from = obj
         return fixed_obj
 
-    root = PythonicAdapter(Pass)._encode(root, None)
+    root = _pythonic._encode(root, None)
 
     i = 0
     objects = [root]
@@ -422,7 +760,7 @@ def encode_network(root):
     objects = []
 
     def get_ref(obj, objects=objects):
-        obj = PythonicAdapter(Pass)._encode(obj, None)
+        obj = _pythonic._encode(obj, None)
 
         if isinstance(obj, (FixedObject, Container)):
             if getattr(obj, '_index', None):
@@ -447,16 +785,19 @@ def decode_obj_table(table_entries, plugin):
     entries = []
     for entry in table_entries:
         if isinstance(entry, Container):
-            assert not hasattr(entry, '__recursion_lock__')
-            user_obj_def = plugin.user_objects[entry.classID]
-            assert entry.version == user_obj_def.version
-            entry = Container(class_name=entry.classID,
-                              **dict(zip(user_obj_def.defaults.keys(),
-                                         entry.values)))
+            entry = decode_user_object(entry, plugin)
         entries.append(entry)
 
     return decode_network(entries)
 
+def decode_user_object(entry, plugin):
+    """Return a user object table entry with its values named by field."""
+    assert not hasattr(entry, '__recursion_lock__')
+    user_obj_def = plugin.user_objects[entry.classID]
+    assert entry.version == user_obj_def.version
+    return Container(class_name=entry.classID,
+                     **dict(zip(user_obj_def.defaults.keys(), entry.values)))
+
 def encode_obj_table(root, plugin):
     """Return list of obj table entries. Converts user-class objects"""
     entries = encode_network(root)
@@ -476,3 +817,248 @@ def encode_obj_table(root, plugin):
         table_entries.append(entry)
     return table_entries
 
+
+
+
+#-- Reading entries on demand --#
+
+_field_sizes = {1: 0, 2: 0, 3: 0, 4: 4, 5: 2, 8: 8, 99: 3}
+
+def _skip_fields(data, pos, count):
+    for i in xrange(count):
+        classID = ord(data[pos])
+        size = _field_sizes.get(classID)
+        if size is not None:
+            pos += 1 + size
+        elif classID in (6, 7):
+            pos += 3 + _UBInt16.unpack_from(data, pos + 1)[0]
+        else:
+            raise ValueError("unknown field classID %i" % classID)
+    return pos
+
+def _skip_length_and_bytes(data, pos, scale=1):
+    return pos + 4 + _UBInt32.unpack_from(data, pos)[0] * scale
+
+def _skip_length_and_fields(data, pos, scale=1):
+    (length,) = _UBInt32.unpack_from(data, pos)
+    return _skip_fields(data, pos + 4, length * scale)
+
+def _skip_bytes(size):
+    return lambda data, pos: pos + size
+
+def _skip_count(count):
+    return lambda data, pos: _skip_fields(data, pos, count)
+
+"""Functions returning the end of each FixedObject, by classID."""
+_fixed_object_skippers = {
+    String.classID: _skip_length_and_bytes,
+    Symbol.classID: _skip_length_and_bytes,
+    ByteArray.classID: _skip_length_and_bytes,
+    SoundBuffer.classID: partial(_skip_length_and_bytes, scale=2),
+    Bitmap.classID: partial(_skip_length_and_bytes, scale=4),
+    UTF8.classID: _skip_length_and_bytes,
+
+    Array.classID: _skip_length_and_fields,
+    OrderedCollection.classID: _skip_length_and_fields,
+    Set.classID: _skip_length_and_fields,
+    IdentitySet.classID: _skip_length_and_fields,
+    Dictionary.classID: partial(_skip_length_and_fields, scale=2),
+    IdentityDictionary.classID: partial(_skip_length_and_fields, scale=2),
+
+    Color.classID: _skip_bytes(4),
+    TranslucentColor.classID: _skip_bytes(5),
+    Point.classID: _skip_count(2),
+    Rectangle.classID: _skip_count(4),
+    Form.classID: _skip_count(5),
+    ColorForm.classID: _skip_count(6),
+}
+
+def _skip_obj_table_entry(data, pos):
+    classID = ord(data[pos])
+    if classID < 99:
+        skip = _fixed_object_skippers.get(classID)
+        if skip is None:
+            raise ValueError("unknown fixed object classID %i" % classID)
+        return skip(data, pos + 1)
+    return _skip_fields(data, pos + 3, ord(data[pos + 2]))
+
+
+class ObjTableReader(object):
+    """An object table which parses its entries only when they're used.
+
+    Creating one makes a single pass over the table to find where each entry
+    starts, without building any objects. Entries are then parsed by index,
+    and :meth:`resolve` follows a :class:`Ref` to the entry it points to.
+    This lets you pick a few objects out of a large table, such as the sprite
+    names, without parsing any of its media.
+
+    :param data: A string or :mod:`mmap` containing the table.
+    :param pos: The offset of the table's header in ``data``.
+    :param plugin: If given, user objects are returned as Containers with
+        named fields, like :func:`decode_obj_table` gives.
+
+    Entries are otherwise the same as :func:`parse_obj_table` gives, so they
+    may contain Refs.
+
+    """
+
+    def __init__(self, data, pos=0, plugin=None):
+        self.data = data
+        self.plugin = plugin
+
+        if data[pos:pos + 10] != OBJ_TABLE_HEADER:
+            raise ValueError("object table header not found")
+        try:
+            (length,) = _UBInt32.unpack_from(data, pos + 10)
+            pos += 14
+            offsets = []
+            for i in xrange(length):
+                offsets.append(pos)
+                pos = _skip_obj_table_entry(data, pos)
+        except (struct.error, IndexError):
+            raise ValueError("unexpected end of file")
+        if pos > len(data):
+            raise ValueError("unexpected end of file")
+
+        self.offsets = offsets
+        """The offset in :attr:`data` of each entry."""
+
+        self.end = pos
+        """The offset in :attr:`data` just after the table."""
+
+        self._entries = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        """Return the entry at ``index``, counting from 0.
+
+        Entries are cached, so each one is only parsed once.
+
+        """
+        if index < 0:
+            raise IndexError("negative index %i" % index)
+        entry = self._entries.get(index)
+        if entry is None:
+            entry = self._entries[index] = self._parse(index)
+        return entry
+
+    def __iter__(self):
+        for index in xrange(len(self.offsets)):
+            yield self[index]
+
+    def _parse(self, index):
+        offset = self.offsets[index]
+        try:
+            (entry, pos) = _parse_obj_table_entry(self.data, offset)
+        except (struct.error, IndexError): # truncated data
+            raise ValueError("unexpected end of file")
+        if self.plugin and isinstance(entry, Container):
+            entry = decode_user_object(entry, self.plugin)
+        return entry
+
+    @property
+    def root(self):
+        """The first entry in the table."""
+        return self[0]
+
+    def resolve(self, value):
+        """Return the entry a :class:`Ref` points to.
+
+        Other values are returned unchanged.
+
+        :raises: :class:`ValueError` if the Ref doesn't point into the table.
+
+        """
+        if isinstance(value, Ref):
+            # first entry is 1
+            if not 1 <= value.index <= len(self.offsets):
+                raise ValueError("invalid reference %r" % value)
+            return self[value.index - 1]
+        return value
+
+    def decode(self):
+        """Return the root of the table with all its references resolved.
+
+        Gives the same result as :func:`decode_network`, or
+        :func:`decode_obj_table` if the reader has a plugin. The cached
+        entries are left alone.
+
+        """
+        return decode_network([self._parse(index)
+                               for index in xrange(len(self.offsets))])
+
+
+def _map_file(fp):
+    """Return a read-only :mod:`mmap` of the file, or None if it isn't a
+    real file.
+
+    The map keeps its own handle, so it stays usable after ``fp`` is closed.
+
+    """
+    try:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+
+
+class ScratchFileReader(object):
+    """A .sb file whose object tables are read with :class:`ObjTableReader`.
+
+    Real files are memory-mapped rather than read into memory, so call
+    :meth:`close` when you're done, or use the reader as a context manager.
+    The stage table is found using the size of the info table, so reading
+    :attr:`info` never touches the stage, and neither table is indexed until
+    it is first used.
+
+    :param fp: A file or file-like object opened for reading.
+    :param plugin: Passed to each :class:`ObjTableReader`.
+
+    """
+
+    def __init__(self, fp, plugin=None):
+        data = _map_file(fp)
+        if data is None:
+            data = fp.read()
+        self.data = data
+        self.plugin = plugin
+
+        header_size = len(SCRATCH_FILE_HEADER)
+        if data[:header_size] != SCRATCH_FILE_HEADER:
+            raise ValueError("not a Scratch 1.4 file")
+        try:
+            (info_size,) = _UBInt32.unpack_from(data, header_size)
+        except struct.error:
+            raise ValueError("unexpected end of file")
+        self._info_pos = header_size + 4
+        self._stage_pos = self._info_pos + info_size
+        self._info = None
+        self._stage = None
+
+    def close(self):
+        """Release the file's memory map, if it has one. The readers can't
+        be used afterwards."""
+        if hasattr(self.data, "close"):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def info(self):
+        """The :class:`ObjTableReader` for the project info."""
+        if self._info is None:
+            self._info = ObjTableReader(self.data, self._info_pos, self.plugin)
+        return self._info
+
+    @property
+    def stage(self):
+        """The :class:`ObjTableReader` for the stage and everything in it."""
+        if self._stage is None:
+            self._stage = ObjTableReader(self.data, self._stage_pos,
+                                         self.plugin)
+        return self._stage
@@ -22,7 +22,12 @@ import json
 import time
 import os
 import hashlib
+import multiprocessing.pool
+import string
 import struct
+import zlib
+
+from collections import OrderedDict
 
 import kurt
 from kurt.plugin import Kurt, KurtPlugin
@@ -32,6 +37,9 @@ from kurt.scratch20.blocks import make_block_types, custom_block, make_spec
 
 SOUND_FORMATS = ['.wav']
 
+COMPRESSED = ['.png', '.jpg']
+"""Extensions of formats which are already compressed."""
+
 WATCHER_MODES = [None,
     'normal',
     'large',
@@ -48,31 +56,151 @@ CATEGORY_COLORS = {
 
 
 def get_blocks_by_id(this_block):
-    if isinstance(this_block, kurt.Script):
-        for block in this_block.blocks:
-            for b in get_blocks_by_id(block):
-                yield b
-    elif isinstance(this_block, kurt.Block):
-        yield this_block
-        for arg in this_block.args:
-            if isinstance(arg, kurt.Block):
-                for block in get_blocks_by_id(arg):
-                    yield block
-            elif isinstance(arg, list):
-                for block in arg:
-                    for b in get_blocks_by_id(block):
-                        yield b
+    if isinstance(this_block, (kurt.Script, kurt.Block)):
+        for (block, parent, index) in this_block.walk():
+            yield block
+
+
+class JSONBackend(object):
+    """Reads and writes project.json with the fastest JSON module available.
+
+    Other modules are only used in ways which give the same results as
+    :mod:`json`: strings are always unicode, floats keep full precision, and
+    anything they refuse to parse, such as ``NaN``, is retried with
+    :mod:`json`.
+
+    :param names: Modules to try, fastest first.
+
+    """
+
+    def __init__(self, names=("ujson", "simplejson", "json")):
+        self.loader = self._import(names)
+        """The module used for parsing."""
+
+        self.dumper = self._import(n for n in names
+                                   if n in ("simplejson", "json"))
+        """The module used for encoding."""
+
+    @staticmethod
+    def _import(names):
+        for name in names:
+            try:
+                return __import__(name)
+            except ImportError:
+                pass
+        return json
+
+    def loads(self, data):
+        try:
+            if self.loader.__name__ == "ujson":
+                return self.loader.loads(data, precise_float=True)
+            elif self.loader.__name__ == "simplejson":
+                # simplejson returns str for ASCII strings, unless given
+                # unicode.
+                return self.loader.loads(data.decode("utf-8"))
+        except ValueError:
+            pass
+        return json.loads(data)
+
+    def encoder(self):
+        """Return a JSONEncoder with the same settings as
+        :func:`json.dumps`."""
+        if self.dumper.__name__ == "simplejson":
+            return self.dumper.JSONEncoder(use_decimal=False,
+                                           namedtuple_as_object=False,
+                                           tuple_as_array=True)
+        return self.dumper.JSONEncoder()
+
+
+def parse_md5(filename):
+    """Return the hex digest from an asset name like ``"<md5>.png"``, or
+    None if it doesn't look like one."""
+    if filename:
+        (md5, extension) = os.path.splitext(filename)
+        if len(md5) == 32 and all(c in string.hexdigits for c in md5):
+            return md5.lower()
+
+def archive_path(fp):
+    """Return the absolute path of the file ``fp`` reads from, or None if it
+    isn't a real file."""
+    name = getattr(fp, "name", None)
+    if isinstance(name, basestring) and os.path.isfile(name):
+        return os.path.abspath(name)
+
+
+class ZipMember(object):
+    """A file inside a zip archive, read from disk when needed.
+
+    The archive is opened again for each read rather than kept open or
+    mapped, so it can still be replaced. If it has been changed since it was
+    loaded, reading raises :class:`IOError`.
+
+    :param path: The archive's path, from :func:`archive_path`.
+    :param info: The member's :class:`zipfile.ZipInfo`.
+    :param stat: ``(size, mtime)`` of the archive when it was loaded.
+
+    """
+
+    def __init__(self, path, info, stat):
+        self.path = path
+        self.info = info
+        self.stat = stat
+
+    @staticmethod
+    def stat_file(fp):
+        st = os.fstat(fp.fileno())
+        return (st.st_size, st.st_mtime)
+
+    def read_raw(self):
+        """Return the member's bytes as stored in the archive."""
+        with open(self.path, "rb") as fp:
+            if self.stat_file(fp) != self.stat:
+                raise IOError("%s has changed since it was loaded" %
+                              self.path)
+            fp.seek(self.info.header_offset)
+            header = fp.read(zipfile.sizeFileHeader)
+            if header[:4] != zipfile.stringFileHeader:
+                raise zipfile.BadZipfile("Bad magic number for file header")
+            (name_length, extra_length) = struct.unpack("<HH", header[26:30])
+            fp.seek(name_length + extra_length, os.SEEK_CUR)
+            raw = fp.read(self.info.compress_size)
+        if len(raw) != self.info.compress_size:
+            raise zipfile.BadZipfile("Truncated file %r" % self.info.filename)
+        return raw
+
+    def read(self):
+        """Return the member's uncompressed contents."""
+        raw = self.read_raw()
+        if self.info.compress_type == zipfile.ZIP_STORED:
+            contents = raw
+        elif self.info.compress_type == zipfile.ZIP_DEFLATED:
+            contents = zlib.decompress(raw, -15)
+        else:
+            raise NotImplementedError("compression method %i" %
+                                      self.info.compress_type)
+        if zlib.crc32(contents) & 0xffffffff != self.info.CRC:
+            raise zipfile.BadZipfile("Bad CRC-32 for file %r" %
+                                     self.info.filename)
+        return contents
 
 
 class ZipReader(object):
-    def __init__(self, fp):
+    def __init__(self, fp, media=True, json_backend=None):
+        self.media = media
         self.zip_file = zipfile.ZipFile(fp, "r")
-        self.json = json.load(self.zip_file.open("project.json"))
+        self.archive = archive_path(fp) if media else None
+        """Media are read from this path lazily, if it's a real file."""
+        if self.archive:
+            self.archive_stat = ZipMember.stat_file(fp)
+        json_backend = json_backend or JSONBackend()
+        self.json = json_backend.loads(self.zip_file.read("project.json"))
         self.project = kurt.Project()
         self.list_watchers = []
         self.loaded_images = {}
         self.loaded_sounds = {}
         self.custom_blocks = {}
+        self.block_inserts = {}
+        """Caches :attr:`BlockType.inserts` for :meth:`load_block`."""
 
         # files
         self.image_filenames = {}
@@ -113,25 +241,45 @@ class ZipReader(object):
 
         self.project.actors += self.list_watchers
 
-    def read_image(self, file_id):
+    def read_image(self, file_id, md5=None):
         if file_id not in self.loaded_images:
             if file_id not in self.image_filenames:
                 return None
             filename = self.image_filenames[file_id]
             (_, extension) = os.path.splitext(filename)
-            contents = self.zip_file.open(filename).read()
             _format = kurt.Image.image_format(extension)
-            self.loaded_images[file_id] = kurt.Image(contents, _format)
+            if self.archive is not None:
+                image = kurt.Image(None, _format)
+                image._source = self.read_member(filename)
+            elif self.media:
+                contents = self.zip_file.open(filename).read()
+                image = kurt.Image(contents, _format)
+            else:
+                image = kurt.Image.placeholder(format=_format)
+            image._md5 = parse_md5(md5)
+            self.loaded_images[file_id] = image
         return self.loaded_images[file_id]
 
-    def read_waveform(self, file_id, rate, sample_count):
+    def read_waveform(self, file_id, rate, sample_count, md5=None):
         if file_id not in self.loaded_sounds:
-            filename = self.sound_filenames[file_id]
-            contents = self.zip_file.open(filename).read()
-            self.loaded_sounds[file_id] = kurt.Waveform(contents, rate,
-                    sample_count)
+            if self.archive is not None:
+                filename = self.sound_filenames[file_id]
+                waveform = kurt.Waveform(None, rate, sample_count)
+                waveform._source = self.read_member(filename)
+            elif self.media:
+                filename = self.sound_filenames[file_id]
+                contents = self.zip_file.open(filename).read()
+                waveform = kurt.Waveform(contents, rate, sample_count)
+            else:
+                waveform = kurt.Waveform.placeholder(rate, sample_count)
+            waveform._md5 = parse_md5(md5)
+            self.loaded_sounds[file_id] = waveform
         return self.loaded_sounds[file_id]
 
+    def read_member(self, filename):
+        return ZipMember(self.archive, self.zip_file.getinfo(filename),
+                         self.archive_stat)
+
     def finish(self):
         self.zip_file.close()
 
@@ -146,22 +294,25 @@ class ZipReader(object):
 
         # costumes
         for cd in sd.get("costumes", []):
-            image = self.read_image(cd['baseLayerID'])
+            image = self.read_image(cd['baseLayerID'],
+                                    cd.get('baseLayerMD5'))
             rotation_center = (cd['rotationCenterX'], cd['rotationCenterY'])
 
             if cd['bitmapResolution'] != 1:
-                (w, h) = image.size
-                w /= cd['bitmapResolution']
-                h /= cd['bitmapResolution']
-                image = image.resize((w, h))
+                if self.media:
+                    (w, h) = image.size
+                    w /= cd['bitmapResolution']
+                    h /= cd['bitmapResolution']
+                    image = image.resize((w, h))
 
                 (x, y) = rotation_center
                 x /= cd['bitmapResolution']
                 y /= cd['bitmapResolution']
                 rotation_center = (x, y)
 
-            if 'text' in cd:
-                text_layer = self.read_image(cd['textLayerID'])
+            if 'text' in cd and self.media:
+                text_layer = self.read_image(cd['textLayerID'],
+                                             cd.get('textLayerMD5'))
                 if text_layer:
                     image = image.paste(text_layer)
 
@@ -173,7 +324,7 @@ class ZipReader(object):
             scriptable.sounds.append(kurt.Sound(
                 snd['soundName'],
                 self.read_waveform(snd['soundID'], snd['rate'],
-                    snd['sampleCount'])
+                    snd['sampleCount'], snd.get('md5'))
             ))
 
         # vars & lists
@@ -260,7 +411,9 @@ class ZipReader(object):
         else:
             block_type = kurt.BlockType.get(command)
 
-        inserts = list(block_type.inserts)
+        if block_type not in self.block_inserts:
+            self.block_inserts[block_type] = block_type.inserts
+        inserts = list(self.block_inserts[block_type])
         args = []
         for arg in block_array:
             insert = inserts.pop(0) if inserts else None
@@ -281,9 +434,12 @@ class ZipReader(object):
                     arg = 'edge'
                 elif insert.kind == 'spriteOnly' and arg == '_myself_':
                     arg = 'myself'
+                else:
+                    arg = kurt.Block._normalize_arg(insert, arg)
             args.append(arg)
+        args += [insert.default for insert in inserts]
 
-        return kurt.Block(block_type, *args)
+        return kurt.Block._from_trusted(block_type, args)
 
     def load_script(self, script_array):
         (x, y, blocks) = script_array
@@ -302,16 +458,109 @@ class ZipReader(object):
         )
 
 
+class AssetStore(object):
+    """A folder of compressed images and sounds, shared between saves.
+
+    Give one to :class:`ZipWriter` -- usually by setting
+    :attr:`Scratch20Plugin.asset_store` -- so that projects using the same
+    media, such as many projects made from one template, reuse the stored
+    copies instead of encoding and compressing them again. The folder can be
+    shared between processes.
+
+    Assets are named by the MD5 of their contents, and kept compressed the
+    way they were first written. Bitmaps converted from
+    another format are also indexed by their pixels, so that they can be
+    found without encoding them first.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for folder in (path, os.path.join(path, "pixels")):
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError: # another process got there first
+                    if not os.path.isdir(folder):
+                        raise
+
+    @staticmethod
+    def pixels_key(pil_image):
+        md5 = hashlib.md5("%s %r " % (pil_image.mode, pil_image.size))
+        md5.update(pil_image.tobytes())
+        return md5.hexdigest()
+
+    def get(self, name):
+        """Return ``(crc, file_size, raw, compress_type)`` for the asset with
+        the given ``md5 + ext`` name, or None if it isn't stored."""
+        data = self._read(name)
+        if data and len(data) >= 10:
+            (crc, file_size, compress_type) = struct.unpack("<IIH", data[:10])
+            return (crc, file_size, data[10:], compress_type)
+
+    def add(self, name, crc, file_size, raw, compress_type):
+        self._write(name, struct.pack("<IIH", crc, file_size, compress_type)
+                          + raw)
+
+    def get_pixels(self, pixels_key, ext):
+        """Return the MD5 of the encoded image with the given pixels."""
+        return self._read(os.path.join("pixels", pixels_key + ext))
+
+    def add_pixels(self, pixels_key, ext, md5):
+        self._write(os.path.join("pixels", pixels_key + ext), md5)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.path, name), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write(self, name, data):
+        # Write to a temporary file first, so other processes never see a
+        # partly-written asset.
+        path = os.path.join(self.path, name)
+        tmp_path = "%s.%i.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        try:
+            os.rename(tmp_path, path)
+        except OSError: # already exists, on Windows
+            os.remove(tmp_path)
+
+
 class ZipWriter(object):
-    def __init__(self, fp, project):
+    def __init__(self, fp, asset_store=None, threads=None,
+                 compress_level=zlib.Z_DEFAULT_COMPRESSION,
+                 store_compressed_media=False, json_backend=None):
         self.zip_file = zipfile.ZipFile(fp, "w")
+        self.json_backend = json_backend or JSONBackend()
+        self.asset_store = asset_store
+        self.threads = threads
+        self.compress_level = compress_level
+        self.store_compressed_media = store_compressed_media
         self.image_dicts = {}
         self.waveform_dicts = {}
+        self.image_ids = {}
+        self.waveform_ids = {}
+        self.prepared_images = {}
+        self.json = None
+
+    def write_project(self, project, debug=False):
+        """Write the media and project.json for ``project`` into the archive.
+
+        Call :attr:`finish` afterwards, even if this fails.
+
+        :param debug: If True, keep the actors in :attr:`json`. Otherwise it
+                      has no ``"children"``, since they're only built one at a
+                      time as project.json is written.
+
+        """
+        self.prepared_images = self.prepare_images(project, self.threads)
 
         self.json = {
             "penLayerMD5": "279467d0d49e152706ed66539b577c00.png",
             "tempoBPM": project.tempo,
-            "children": [],
             "info": {
                 "comment": project.notes,
                 "author": project.author,
@@ -327,58 +576,329 @@ class ZipWriter(object):
             "videoAlpha": 0.5,
         }
 
+        # Write the media first, so that project.json can be streamed into
+        # the archive one scriptable at a time.
+        for scriptable in [project.stage] + project.sprites:
+            for costume in scriptable.costumes:
+                self.write_image(costume.image)
+            for sound in scriptable.sounds:
+                self.write_waveform(sound.waveform)
+
         self.json.update(self.save_scriptable(project.stage))
-        sprites = {}
-        for (i, sprite) in enumerate(project.sprites):
-            sprites[sprite.name] = self.save_scriptable(sprite, i)
+        children = [] if debug else None
+        self.write_stream("project.json", self.iter_json(project, children))
+        if debug:
+            self.json["children"] = children
+
+    def iter_json(self, project, children=None):
+        """Yield the contents of project.json in chunks, one per actor.
+
+        Each sprite is only built when it's reached, so the whole document
+        is never in memory at once. Actors are encoded in one go rather than
+        with ``iterencode``, which only uses the pure-Python encoder.
+
+        :param children: If given, a list to append each actor's dict to.
+
+        """
+        encoder = self.json_backend.encoder()
+        head = encoder.encode(self.json)
+        assert head.endswith("}")
+        yield head[:-1] + ', "children": ['
+
+        sprite_indexes = dict((sprite.name, i)
+                              for (i, sprite) in enumerate(project.sprites))
+        separator = ""
         for actor in project.actors:
             if isinstance(actor, kurt.Sprite):
-                actor = sprites[actor.name]
+                actor = self.save_scriptable(actor,
+                                             sprite_indexes[actor.name])
             elif isinstance(actor, kurt.Watcher):
                 actor = self.save_watcher(actor)
 
             if actor:
-                self.json["children"].append(actor)
-
-        self.write_file("project.json", json.dumps(self.json))
+                if children is not None:
+                    children.append(actor)
+                yield separator + encoder.encode(actor)
+                separator = ", "
+        yield "]}"
 
     def finish(self):
         self.zip_file.close()
 
-    def write_file(self, name, contents):
-        """Write file contents string into archive."""
-        # TODO: find a way to make ZipFile accept a file object.
+    def write_file(self, name, contents, level=None):
+        """Write file contents string into archive.
+
+        :param level: zlib compression level, or 0 to store the file
+                      uncompressed. Defaults to :attr:`compress_level`.
+        :returns: ``(crc, raw, compress_type)``: the CRC-32 of the contents,
+                  and the bytes written and how they're compressed.
+
+        """
+        if level is None:
+            level = self.compress_level
+        crc = zlib.crc32(contents) & 0xffffffff
+        if level == 0:
+            (raw, compress_type) = (contents, zipfile.ZIP_STORED)
+        else:
+            co = zlib.compressobj(level, zlib.DEFLATED, -15)
+            raw = co.compress(contents) + co.flush()
+            compress_type = zipfile.ZIP_DEFLATED
+        self.write_raw(name, raw, crc, len(contents), compress_type)
+        return (crc, raw, compress_type)
+
+    def write_stream(self, name, chunks, level=None):
+        """Write file contents into archive from an iterable of strings,
+        compressing them as they arrive.
+
+        Small chunks are joined into buffers of at least
+        :attr:`STREAM_BUFFER_SIZE` bytes before they're compressed.
+
+        If :attr:`_start_member` can't add the file -- say, the archive isn't
+        seekable, so the header can't be filled in afterwards -- the contents
+        are joined and written with ``ZipFile.writestr`` instead, at its
+        default compression level.
+
+        """
+        if level is None:
+            level = self.compress_level
         zi = zipfile.ZipInfo(name)
         zi.date_time = time.localtime(time.time())[:6]
-        zi.compress_type = zipfile.ZIP_DEFLATED
+        zi.compress_type = (zipfile.ZIP_STORED if level == 0
+                            else zipfile.ZIP_DEFLATED)
         zi.external_attr = 0777 << 16L
-        self.zip_file.writestr(zi, contents)
+        zi.file_size = zi.compress_size = zi.CRC = 0
+
+        zf = self.zip_file
+        if not self._start_member(zi, seek=True):
+            zf.writestr(zi, "".join(chunks))
+            return
+
+        co = None
+        if zi.compress_type == zipfile.ZIP_DEFLATED:
+            co = zlib.compressobj(level, zlib.DEFLATED, -15)
+        crc = 0
+        for chunk in self._buffer_chunks(chunks):
+            crc = zlib.crc32(chunk, crc)
+            zi.file_size += len(chunk)
+            if co:
+                chunk = co.compress(chunk)
+            zi.compress_size += len(chunk)
+            zf.fp.write(chunk)
+        if co:
+            chunk = co.flush()
+            zi.compress_size += len(chunk)
+            zf.fp.write(chunk)
+        zi.CRC = crc & 0xffffffff
+
+        if (zi.file_size > zipfile.ZIP64_LIMIT or
+                zi.compress_size > zipfile.ZIP64_LIMIT):
+            raise zipfile.LargeZipFile("Filesize would require ZIP64 "
+                                       "extensions")
+        end = zf.fp.tell()
+        zf.fp.seek(zi.header_offset)
+        zf.fp.write(zi.FileHeader(False))
+        zf.fp.seek(end)
+        zf.filelist.append(zi)
+        zf.NameToInfo[zi.filename] = zi
+
+    def _start_member(self, zi, zip64=False, seek=False):
+        """Add ``zi`` to the end of the archive and write its file header.
+
+        zipfile has no public way to add a member without passing it all of
+        the contents, so this does the same as ``ZipFile.writestr`` using its
+        private ``_writecheck``, ``_didModify`` and ``_allowZip64``. They're
+        only touched here.
+
+        :param seek: Whether the caller needs to seek back to rewrite the
+                     header afterwards.
+        :returns: False if the member wasn't started, because zipfile doesn't
+                  have those attributes or the archive can't seek. Use
+                  ``writestr`` instead.
+
+        """
+        zf = self.zip_file
+        if not (hasattr(zf, "_writecheck") and hasattr(zf, "_didModify")):
+            return False
+        try:
+            zi.header_offset = zf.fp.tell()
+            if seek:
+                zf.fp.seek(zi.header_offset)
+        except (AttributeError, IOError):
+            return False
+        if zip64 and not getattr(zf, "_allowZip64", False):
+            raise zipfile.LargeZipFile("Filesize would require ZIP64 "
+                                       "extensions")
+        zf._writecheck(zi)
+        zf._didModify = True
+        zf.fp.write(zi.FileHeader(zip64))
+        return True
+
+    STREAM_BUFFER_SIZE = 64 * 1024
+
+    def _buffer_chunks(self, chunks):
+        buf = []
+        size = 0
+        for chunk in chunks:
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= self.STREAM_BUFFER_SIZE:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield "".join(buf)
+
+    def write_raw(self, name, raw, crc, file_size,
+                  compress_type=zipfile.ZIP_DEFLATED):
+        """Write already-compressed file contents into archive."""
+        zi = zipfile.ZipInfo(name)
+        zi.date_time = time.localtime(time.time())[:6]
+        zi.compress_type = compress_type
+        zi.external_attr = 0777 << 16L
+        zi.file_size = file_size
+        zi.compress_size = len(raw)
+        zi.CRC = crc
+
+        # The same as ZipFile.writestr, minus the compression.
+        zf = self.zip_file
+        zip64 = (zi.file_size > zipfile.ZIP64_LIMIT or
+                 zi.compress_size > zipfile.ZIP64_LIMIT)
+        if not self._start_member(zi, zip64):
+            if compress_type == zipfile.ZIP_DEFLATED:
+                raw = zlib.decompress(raw, -15)
+            zf.writestr(zi, raw)
+            return
+        zf.fp.write(raw)
+        zf.filelist.append(zi)
+        zf.NameToInfo[zi.filename] = zi
+
+    def write_member(self, name, member):
+        """Copy a :class:`ZipMember` into the archive as-is, without
+        decompressing it."""
+        info = member.info
+        self.write_raw(name, member.read_raw(), info.CRC, info.file_size,
+                       info.compress_type)
+
+    def write_asset(self, media, ext, asset_ids, stored=None):
+        """Write an Image or Waveform into the archive, once for each
+        distinct contents.
+
+        :param asset_ids: Dict of ``md5 + ext`` to asset ID, for either
+                          images or sounds.
+        :param stored: The asset from :attr:`asset_store`, if already found.
+        :returns: ``(asset_id, md5)``
+
+        """
+        member = media._source
+        md5 = media.md5
+        name = md5 + ext
+
+        if name not in asset_ids:
+            asset_id = asset_ids[name] = len(asset_ids)
+            filename = str(asset_id) + ext
+            if isinstance(member, ZipMember):
+                # Unchanged from the archive we loaded: copy it straight
+                # through.
+                self.write_member(filename, member)
+            else:
+                if self.asset_store and not stored:
+                    stored = self.asset_store.get(name)
+                if stored:
+                    (crc, file_size, raw, compress_type) = stored
+                    self.write_raw(filename, raw, crc, file_size,
+                                   compress_type)
+                else:
+                    level = None
+                    if self.store_compressed_media and ext in COMPRESSED:
+                        level = 0 # deflating it again would gain little
+                    contents = media.contents
+                    (crc, raw, compress_type) = self.write_file(filename,
+                            contents, level)
+                    if self.asset_store:
+                        self.asset_store.add(name, crc, len(contents), raw,
+                                             compress_type)
+        return (asset_ids[name], md5)
+
+    def prepare_images(self, project, threads=None):
+        """Convert and encode the images which aren't already in a format
+        sb2 supports, using a pool of threads. PIL releases the GIL while
+        encoding.
+
+        :param threads: Number of threads. Defaults to the number of CPUs.
+                        If 1, images are encoded one at a time as they're
+                        written instead.
+        :returns: Dict of ``id(image)`` to the result of
+                  :attr:`prepare_image`.
+
+        """
+        pending = OrderedDict()
+        for scriptable in [project.stage] + project.sprites:
+            for costume in scriptable.costumes:
+                image = costume.image
+                if image.format not in ("SVG", "JPEG", "PNG"):
+                    pending[id(image)] = image
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        if threads == 1 or len(pending) < 2:
+            return {}
+
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            results = pool.map(self.prepare_image, pending.values())
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(pending.keys(), results))
+
+    def prepare_image(self, image):
+        """Convert the image to a format sb2 supports and encode it, unless
+        :attr:`asset_store` already has it. Safe to call from any thread.
+
+        :returns: ``(converted, ext, stored, pixels_key)``
+
+        """
+        converted = image.convert("SVG", "JPEG", "PNG")
+        ext = (converted.extension or ".png")
+
+        stored = pixels_key = None
+        if converted is not image:
+            # Look up newly-converted images by their pixels, so they don't
+            # need encoding if the store already has them.
+            if self.asset_store:
+                pixels_key = AssetStore.pixels_key(converted.pil_image)
+                md5 = self.asset_store.get_pixels(pixels_key, ext)
+                stored = md5 and self.asset_store.get(md5 + ext)
+                if stored:
+                    converted._md5 = md5
+            if not stored:
+                converted.md5 # encode it
+        return (converted, ext, stored, pixels_key)
 
     def write_image(self, image):
         if image not in self.image_dicts:
-            image_id = len(self.image_dicts)
-            image = image.convert("SVG", "JPEG", "PNG")
-            ext = (image.extension or ".png")
-            filename = str(image_id) + ext
-            self.write_file(filename, image.contents)
+            prepared = self.prepared_images.pop(id(image), None)
+            (converted, ext, stored, pixels_key) = (prepared or
+                                                    self.prepare_image(image))
+            (image_id, md5) = self.write_asset(converted, ext,
+                                               self.image_ids, stored)
+            if pixels_key and not stored:
+                self.asset_store.add_pixels(pixels_key, ext, md5)
 
             self.image_dicts[image] = {
                 "baseLayerID": image_id, # -1 for download
                 "bitmapResolution": 1,
-                "baseLayerMD5": hashlib.md5(image.contents).hexdigest() + ext,
+                "baseLayerMD5": md5 + ext,
             }
         return self.image_dicts[image]
 
     def write_waveform(self, waveform):
         if waveform not in self.waveform_dicts:
-            waveform_id = len(self.waveform_dicts)
-            filename = str(waveform_id) + waveform.extension
-            self.write_file(filename, waveform.contents)
+            (waveform_id, md5) = self.write_asset(waveform,
+                    waveform.extension, self.waveform_ids)
 
             self.waveform_dicts[waveform] = {
                 "soundID": waveform_id, # -1 for download
-                "md5": hashlib.md5(waveform.contents).hexdigest() + \
-                        waveform.extension,
+                "md5": md5 + waveform.extension,
                 "rate": waveform.rate,
                 "sampleCount": waveform.sample_count,
                 "format": "",
@@ -550,7 +1070,7 @@ class ZipWriter(object):
         return [x, y, 150, h, expanded, -1, comment.text]
 
     def save_costume(self, costume):
-        cd = self.write_image(costume.image)
+        cd = dict(self.write_image(costume.image))
         (rx, ry) = costume.rotation_center
         cd.update({
             "costumeName": costume.name,
@@ -560,7 +1080,7 @@ class ZipWriter(object):
         return cd
 
     def save_sound(self, sound):
-        snd = self.write_waveform(sound.waveform)
+        snd = dict(self.write_waveform(sound.waveform))
         snd.update({
             "soundName": sound.name,
         })
@@ -584,15 +1104,40 @@ class Scratch20Plugin(KurtPlugin):
     ]
     blocks = make_block_types()
 
-    def load(self, fp):
-        zl = ZipReader(fp)
+    asset_store = None
+    """An :class:`AssetStore` to use when saving, if any."""
+
+    json_backend = JSONBackend()
+    """The :class:`JSONBackend` used to read and write project.json."""
+
+    def load(self, fp, media=True):
+        zl = ZipReader(fp, media, self.json_backend)
         zl.project._original = zl.json
         zl.finish()
         return zl.project
 
-    def save(self, fp, project):
-        zw = ZipWriter(fp, project)
-        zw.finish()
+    def save(self, fp, project, compress_level=zlib.Z_DEFAULT_COMPRESSION,
+             store_compressed_media=False, encode_threads=None, debug=False):
+        """Save a project as .sb2.
+
+        :param compress_level: zlib compression level for files, from 1
+            (fastest) to 9 (smallest). 0 stores them uncompressed.
+        :param store_compressed_media: If True, PNG and JPEG images are stored
+            without compressing them again. Faster, and usually only a little
+            bigger.
+        :param encode_threads: Number of threads to encode images with.
+            Defaults to the number of CPUs.
+        :param debug: If True, the returned JSON includes the sprites and
+            watchers.
+        :returns: The JSON for project.json.
+
+        """
+        zw = ZipWriter(fp, self.asset_store, encode_threads, compress_level,
+                       store_compressed_media, self.json_backend)
+        try:
+            zw.write_project(project, debug)
+        finally:
+            zw.finish()
         return zw.json
 
 
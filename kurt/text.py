@@ -24,9 +24,13 @@ http://wiki.scratch.mit.edu/wiki/Block_Plugin
 This parser supports most of the block plugin syntax. Most notably, using < >
 for boolean shaped blocks is not supported.
 
+Use :func:`parse`, or a :class:`Parser` per thread. The parser keeps no state
+at module level, so several threads can parse at once.
+
 """
 
 import re
+import threading
 from collections import OrderedDict
 
 import kurt
@@ -45,7 +49,7 @@ class symbol(Token):
     lbp = 0
 
 class literal(Token):
-    def nud(self):
+    def nud(self, parser):
         return self.value
 
 class number(Token):
@@ -54,42 +58,41 @@ class number(Token):
         if int(value) == value:
             value = int(value)
         self.value = value
-    def nud(self):
+    def nud(self, parser):
         return self
 
 class string(Token):
     lbp = 0
-    def nud(self):
+    def nud(self, parser):
         return self
 
 class color(Token):
-    def nud(self):
+    def nud(self, parser):
         self.value = kurt.Color(self.value)
         return self
 
 class lparen(Token):
     lbp = 0
-    def nud(self):
-        global token
-        contents = expression()
+    def nud(self, parser):
+        contents = parser.expression()
         if isinstance(contents, rparen): # empty brackets
             return
-        if not isinstance(token, rparen):
+        if not isinstance(parser.token, rparen):
             raise SyntaxError("Expected bracket to match %s" % self.value)
-        token = next()
+        parser.advance()
         return contents
 
 class rparen(Token):
     lbp = 0
-    def nud(self):
+    def nud(self, parser):
         return self
 
 class newline(symbol):
     name = "EOL"
     lbp = 3
-    def nud(self):
+    def nud(self, parser):
         return []
-    def led(self, left):
+    def led(self, parser, left):
         if isinstance(left, kurt.Block):
             left = [left]
         return left
@@ -110,10 +113,30 @@ class end_token(Token):
 # - postfix ("_ sensor value")
 # - insert transformations ("var", "list", "param", "{}")
 
+_block_tables = (None, {})
+
+def block_table(name, build):
+    """Return ``build()``, cached by ``name`` until :class:`Kurt
+    <kurt.plugin.Kurt>` rebuilds its block index.
+
+    Tables must not be changed once built, as they are shared between
+    threads.
+
+    """
+    global _block_tables
+    (index, tables) = _block_tables
+    if index is not kurt.plugin.Kurt._blocks_by_command:
+        index = kurt.plugin.Kurt._blocks_by_command
+        tables = {}
+        _block_tables = (index, tables)
+    if name not in tables:
+        tables[name] = build()
+    return tables[name]
+
 def inline_blocks():
-    for block in kurt.plugin.Kurt.blocks:
-        if len(block.inserts) == 1 and block.inserts[0].shape == "inline":
-            yield block
+    return block_table("inline_blocks", lambda: [block
+        for block in kurt.plugin.Kurt.blocks
+        if len(block.inserts) == 1 and block.inserts[0].shape == "inline"])
 
 def all_the_blocks():
     for block in kurt.plugin.Kurt.blocks:
@@ -130,23 +153,74 @@ def match_part(part, block_part):
     else:
         return (block_part.strip() == part)
 
-def blocks_starting_with(parts):
-    suppress_blocks = set(suppress_block_names())
+class BlockTrie(object):
+    """Prefix tree over the parts of each block from :attr:`all_the_blocks`.
 
-    for block in all_the_blocks():
-        if len(parts) > len(block.parts):
-            continue
+    Text parts are edges matched literally, and each :class:`Insert` is a
+    wildcard edge, the same as :attr:`match_part`. Following the parsed parts
+    from the root narrows down the candidate blocks without looking at any of
+    the others.
+
+    """
+
+    def __init__(self):
+        self.literals = {}
+        self.insert = None
+        self.blocks = []
+        """Blocks whose parts start with the parts leading to this node."""
+        self.complete = []
+        """Blocks with exactly the parts leading to this node."""
+
+    def add(self, block):
+        node = self
+        node.blocks.append(block)
+        for part in block.parts:
+            if isinstance(part, kurt.Insert):
+                if node.insert is None:
+                    node.insert = BlockTrie()
+                node = node.insert
+            else:
+                node = node.literals.setdefault(part.strip(), BlockTrie())
+            node.blocks.append(block)
+        node.complete.append(block)
+
+    def find(self, parts):
+        """Return the node reached by following the parts, or None."""
+        node = self
+        for part in parts:
+            if isinstance(part, basestring):
+                node = node.literals.get(part)
+            elif isinstance(part, (Token, kurt.Block, list)):
+                node = node.insert
+            else:
+                return None
+            if node is None:
+                return None
+        return node
+
+def block_trie():
+    """Return the :class:`BlockTrie` of every block. Cached."""
+    def build():
+        trie = BlockTrie()
+        for block in all_the_blocks():
+            trie.add(block)
+        return trie
+    return block_table("block_trie", build)
+
+def blocks_starting_with(parts, suppress_blocks=frozenset()):
+    """Yield blocks whose parts start with ``parts``, except those whose first
+    part is in ``suppress_blocks`` (see :attr:`suppress_block_names`)."""
+    node = block_trie().find(parts)
+    if node is None:
+        return
+    for block in node.blocks:
         if (isinstance(block.parts[0], basestring)
                 and block.parts[0].strip() in suppress_blocks):
             continue
-        for (p, bp) in zip(parts, block.parts):
-            if not match_part(p, bp):
-                break
-        else:
-            yield block
+        yield block
 
-def next_block_part(parts):
-    for block in blocks_starting_with(parts):
+def next_block_part(parts, suppress_blocks=frozenset()):
+    for block in blocks_starting_with(parts, suppress_blocks):
         next_part = (block.parts[len(parts)]
                      if len(block.parts) > len(parts)
                      else None)
@@ -155,16 +229,10 @@ def next_block_part(parts):
         yield next_part
 
 def blocks_by_parts(parts):
-    for block in all_the_blocks():
-        if len(parts) != len(block.parts):
-            continue
-        for (p, bp) in zip(parts, block.parts):
-            if not match_part(p, bp):
-                break
-        else:
-            yield block
+    node = block_trie().find(parts)
+    return list(node.complete) if node else []
 
-def block_from_parts(parts):
+def block_from_parts(parser, parts):
     args = []
     for part in parts:
         if isinstance(part, (Token, kurt.Block, list)):
@@ -188,7 +256,7 @@ def block_from_parts(parts):
                 else:
                     arg = arg.value
             elif (isinstance(arg, kurt.Block) and
-                    arg.type.text in insert.options(context)):
+                    arg.type.text in parser.options(insert)):
                 arg = arg.type.text
 
             ok = False
@@ -215,7 +283,7 @@ def block_from_parts(parts):
                                         kurt.Block)):
                         ok = True
                 if insert.shape in ("readonly-menu", "number-menu"):
-                    if (str(arg) in insert.options(context)
+                    if (str(arg) in parser.options(insert)
                             or isinstance(arg, kurt.Block)):
                         ok = True
 
@@ -228,58 +296,58 @@ def block_from_parts(parts):
         else:
             return kurt.Block(block, *block_args)
     else:
-        throw("Wrong type of arguments to block: %s" % failure, repr(parts))
+        parser.throw("Wrong type of arguments to block: %s" % failure,
+                     repr(parts))
 
 class iden(Token):
     @property
     def lbp(self):
         return PRECEDENCE.get(self.value, 100)
 
-    def nud(self):
+    def nud(self, parser):
         try:
-            return self.parse_block([self.value])
+            return self.parse_block(parser, [self.value])
         except SyntaxError:
             for block in inline_blocks():
-                if self.value in block.inserts[0].options(context):
+                if self.value in parser.options(block.inserts[0]):
                     return kurt.Block(block, self.value)
 
-            if len(self.parts) == 1 and self.value in set(make_menu_tokens()):
+            if len(self.parts) == 1 and self.value in parser.menu_tokens:
                 return iden(self.value)
             else:
                 raise
 
-    def led(self, left):
+    def led(self, parser, left):
         if isinstance(left, list):
-            return left + [self.parse_block([self.value])]
+            return left + [self.parse_block(parser, [self.value])]
         else:
-            return self.parse_block([left, self.value])
+            return self.parse_block(parser, [left, self.value])
 
-    def parse_block(self, parts):
-        global token
+    def parse_block(self, parser, parts):
         self.parts = parts
         while 1:
-            part = self.parse_one_part(parts)
+            part = self.parse_one_part(parser, parts)
             if part is not None:
                 if isinstance(part, rparen):
                     part = False
                 parts.append(part)
             else:
-                block = block_from_parts(parts)
-                if isinstance(token, end_token):
+                block = block_from_parts(parser, parts)
+                if isinstance(parser.token, end_token):
                     return block
 
                 if block.type.has_insert("stack"):
-                    if not token.value == "end":
-                        throw("Expected 'end' after C mouth")
-                    token = next()
+                    if not parser.token.value == "end":
+                        parser.throw("Expected 'end' after C mouth")
+                    parser.advance()
                 return block
 
-    def parse_one_part(self, parts):
-        global token, next
-        expect = set(next_block_part(parts))
+    def parse_one_part(self, parser, parts):
+        token = parser.token
+        expect = set(next_block_part(parts, parser.suppress_blocks))
         if not expect:
             self.parts = parts
-            throw("Can't find block %r" % parts)
+            parser.throw("Can't find block %r" % parts)
 
         if expect == set(['']):
             return ''
@@ -288,18 +356,16 @@ class iden(Token):
 
         if isinstance(token, iden):
             text_segments = filter(lambda p: isinstance(p, basestring), expect)
-            menu_inserts = filter(lambda i: i.options(context), all_inserts)
+            menu_inserts = filter(parser.options, all_inserts)
 
             if token.value in text_segments:
-                part = token.value
-                token = next()
-                return part
+                parser.advance()
+                return token.value
 
             for insert in menu_inserts:
-                if token.value in insert.options(context):
-                    part = token
-                    token = next()
-                    return part
+                if token.value in parser.options(insert):
+                    parser.advance()
+                    return token
 
         if None in expect:
             return None
@@ -309,17 +375,17 @@ class iden(Token):
             if isinstance(token, end_token):
                 part = []
             else:
-                part = expression(1)
+                part = parser.expression(1)
             assert isinstance(part, list)
             return part
 
         if isinstance(token, (newline, end_token)):
-            throw("Unexpected EOL", expected=expect)
+            parser.throw("Unexpected EOL", expected=expect)
 
         if all_inserts:
-            return expression(self.lbp)
+            return parser.expression(self.lbp)
 
-        throw("Wrong argument", expected=expect)
+        parser.throw("Wrong argument", expected=expect)
 
 
 #-- Tokenizer --#
@@ -350,7 +416,9 @@ TOKENS = [(re.compile(r), cls) for (r, cls) in [
 ]]
 
 NEWLINE_PAT = re.compile(r'\n|\r|\r\n')
-SEPARATOR_PAT = re.compile(r'[^A-Za-z:#%+*-,=<?>]')
+BLANK_LINES_PAT = re.compile(r'(?:\r\n|\r|\n)(?:[ \t]*(?:\r\n|\r|\n))+')
+SEPARATOR = r'[^A-Za-z:#%+*-,=<?>]'
+SEPARATOR_PAT = re.compile(SEPARATOR)
 WHITESPACE_PAT = re.compile(r'[ \t]+')
 
 SEGMENT_ALIASES = {
@@ -370,114 +438,308 @@ def make_block_tokens():
     for alias in SEGMENT_ALIASES:
         yield alias
 
-def make_menu_tokens():
-    global context
+def make_menu_tokens(context=None):
     for kind in kurt.Insert.KIND_OPTIONS:
         if kind == "broadcast": continue
         for o in kurt.Insert(None, kind).options(context):
             yield str(o)
 
-def suppress_block_names():
+def suppress_block_names(context=None):
     for block in kurt.plugin.Kurt.blocks:
         if isinstance(block.parts[0], kurt.Insert):
             for o in block.parts[0].options(context):
                 yield o
 
-def tokenize(program):
-    block_tokens = sorted(set(make_block_tokens()) | set(make_menu_tokens()))
-    block_tokens.sort(key=len, reverse=True)
-    block_tokens = filter(lambda x: not x.isdigit(), block_tokens)
-    block_tokens = filter(None, block_tokens)
-
-    global remain, lineno
-    remain = program
+def block_tokens():
+    """Return a frozenset of :attr:`make_block_tokens`. Cached."""
+    return block_table("block_tokens",
+                       lambda: frozenset(make_block_tokens()))
+
+def trie_regex(words):
+    """Return a regex matching any of the words, prefering longer ones.
+
+    The words are merged into a trie, so the regex only has to check each
+    character once, rather than trying every word in turn.
+
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = None
+    if not trie:
+        return "(?!)"
+
+    def build(node):
+        # Backtracking reaches the end of a word after the longer ones.
+        alternatives = [re.escape(char) + build(child)
+                        for (char, child) in sorted(node.items()) if char]
+        if "" in node:
+            alternatives.append("")
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return "(?:%s)" % "|".join(alternatives)
+    return build(trie)
+
+_token_patterns = OrderedDict()
+_token_patterns_lock = threading.Lock()
+
+def token_pattern(menu_tokens):
+    """Return a compiled regex matching one block or menu token, followed by a
+    separator.
+
+    The longest token that fits is matched. Patterns are cached for the most
+    recently used sets of menu tokens.
+
+    """
+    key = (block_tokens(), frozenset(menu_tokens))
+    with _token_patterns_lock:
+        if key in _token_patterns:
+            return _token_patterns[key]
+
+        tokens = [t for t in key[0] | key[1] if t and not t.isdigit()]
+        pattern = re.compile(r"(%s)(?=%s|\Z)" % (trie_regex(tokens),
+                                                 SEPARATOR))
+        _token_patterns[key] = pattern
+        while len(_token_patterns) > 16:
+            _token_patterns.popitem(last=False)
+        return pattern
+
+def split_scripts(program):
+    """Yield ``(text, lineno, offset)`` for each script in the program.
+
+    Scripts are separated by one or more blank lines. ``lineno`` and
+    ``offset`` give where the script's text starts in the program.
+
+    """
+    start = 0
     lineno = 1
-    while remain:
-        m = WHITESPACE_PAT.match(remain)
-        if m:
-            remain = remain[m.end():]
-            if not remain:
-                break
+    for m in BLANK_LINES_PAT.finditer(program):
+        text = program[start:m.start()]
+        if text.strip():
+            yield (text, lineno, start)
+        lineno += len(NEWLINE_PAT.findall(program, start, m.end()))
+        start = m.end()
+    text = program[start:]
+    if text.strip():
+        yield (text, lineno, start)
 
-        for (pat, cls) in TOKENS:
-            m = pat.match(remain)
-            if m:
-                if m.groups():
-                    contents = m.group(1)
-                else:
-                    contents = m.group(0).strip()
-                yield cls(contents)
-                remain = remain[m.end():]
-                if cls == newline:
-                    lineno += 1
-                break
-        else:
-            for value in block_tokens:
-                if remain.startswith(value):
-                    after_value = remain[len(value):]
-                    if not after_value or SEPARATOR_PAT.match(after_value[0]):
-                        value = SEGMENT_ALIASES.get(value, value)
-                        yield iden(value)
-                        remain = after_value
-                        break
-            else:
-                throw("Unknown token at %r" % remain.split("\n")[0])
-    yield end_token()
+def tokenize(program, scriptable=None):
+    """Yield the tokens in ``program``. See :attr:`Parser.tokenize`."""
+    return Parser(scriptable).tokenize(program)
 
 
 
 #-- Parser --#
 
-p_input = ""
-
-def expression(rbp=0):
-    global token
-    t = token
-    token = next()
-    left = t.nud()
-    if not hasattr(token, "lbp"):
-        throw("Not an operator: %r" % token)
-    while rbp < token.lbp:
-        t = token
-        token = next()
-        left = t.led(left)
-        if not hasattr(token, "lbp"):
-            throw("Not an operator: %r" % token)
-    return left
+class Parser(object):
+    """Top-down operator precedence parser for block plugin text.
+
+    Each Parser keeps the state of the text it's parsing, so a Parser must
+    only be used by one thread at once; separate Parsers can be used
+    concurrently. The grammar tables are shared between Parsers, and cached.
+
+    :param scriptable: The :class:`Scriptable` used as context, for variable
+                       names, costumes and so on.
+
+    """
+
+    def __init__(self, scriptable=None):
+        self.context = scriptable
+
+        self.menu_tokens = frozenset(make_menu_tokens(scriptable))
+        self.suppress_blocks = frozenset(suppress_block_names(scriptable))
+        self.token_pattern = token_pattern(self.menu_tokens)
+        self._options = {}
+
+        self.program = ""
+        self._lines = None
+        self.position = 0
+        self.lineno = 1
+        self.token = None
+        self._next = None
+
+    def options(self, insert):
+        """Return the options to ``insert`` in this Parser's context, as a
+        set.
+
+        Like :attr:`menu_tokens`, these are found once per Parser, so that
+        eg. broadcast names aren't collected from every script for each
+        block parsed.
+
+        Nothing is cached between Parsers. Each call to
+        :attr:`Scriptable.parse` still collects the project's broadcasts once,
+        but always sees changes made to its scripts since the last call.
+
+        """
+        options = self._options.get(insert.kind)
+        if options is None:
+            options = self._options[insert.kind] = \
+                frozenset(insert.options(self.context))
+        return options
+
+    def tokenize(self, program):
+        """Yield the tokens in ``program``, ending with an :class:`end_token`.
+
+        Updates :attr:`position` and :attr:`lineno` as it goes, for errors.
+
+        """
+        self.program = program
+        self._lines = None
+        self.position = 0
+        self.lineno = 1
+        end = len(program)
+        while self.position < end:
+            m = WHITESPACE_PAT.match(program, self.position)
+            if m:
+                self.position = m.end()
+                if self.position == end:
+                    break
+
+            for (pat, cls) in TOKENS:
+                m = pat.match(program, self.position)
+                if m:
+                    if m.groups():
+                        contents = m.group(1)
+                    else:
+                        contents = m.group(0).strip()
+                    yield cls(contents)
+                    self.position = m.end()
+                    if cls == newline:
+                        self.lineno += 1
+                    break
+            else:
+                m = self.token_pattern.match(program, self.position)
+                if m:
+                    value = m.group(1)
+                    yield iden(SEGMENT_ALIASES.get(value, value))
+                    self.position = m.end()
+                else:
+                    self.throw("Unknown token at %r" %
+                               program[self.position:].split("\n")[0])
+        yield end_token()
 
-def parse(program, scriptable):
-    global token, next, context, p_input
+    def advance(self):
+        """Move on to the next token."""
+        try:
+            self.token = self._next()
+        except StopIteration:
+            self.throw("Unexpected end of input")
+
+    def expression(self, rbp=0):
+        t = self.token
+        if isinstance(t, end_token):
+            self.throw("Unexpected end of input")
+        elif not hasattr(t, "nud"):
+            self.throw("Unexpected %r" % t)
+        self.advance()
+        left = t.nud(self)
+        if not hasattr(self.token, "lbp"):
+            self.throw("Not an operator: %r" % self.token)
+        while rbp < self.token.lbp:
+            t = self.token
+            if not hasattr(t, "led"):
+                self.throw("Unexpected %r" % t)
+            self.advance()
+            left = t.led(self, left)
+            if not hasattr(self.token, "lbp"):
+                self.throw("Not an operator: %r" % self.token)
+        return left
 
-    # for errors
-    p_input = program
+    def parse(self, program):
+        """Parse the text and return a :class:`Script`.
+
+        :raises: :py:class:`SyntaxError` if the text can't be parsed.
+
+        """
+        self._next = self.tokenize(program).next
+        self.advance()
+        result = self.expression()
+        if not isinstance(self.token, end_token):
+            self.throw("Expected end of input")
+        if isinstance(result, kurt.Block):
+            result = [result]
+        if not isinstance(result, list):
+            self.throw("Result does not evaluate to a block")
+        return kurt.Script(result)
+
+    def parse_scripts(self, program, errors=None):
+        """Parse text containing scripts separated by blank lines.
+
+        Returns a list of :class:`Scripts <Script>`. Errors give line numbers
+        within the whole text.
+
+        :param errors: If given a list, the :py:class:`SyntaxError` or
+                       :class:`UnknownBlock` for each script that can't be
+                       parsed is added to it, and the other scripts are still
+                       returned.
+
+        :raises: :py:class:`SyntaxError` for the first script that can't be
+                 parsed, unless ``errors`` is given.
+
+        """
+        scripts = []
+        for (text, lineno, offset) in split_scripts(program):
+            try:
+                scripts.append(self.parse(text))
+            except SyntaxError, err:
+                if err.lineno is not None:
+                    err.lineno += lineno - 1
+                if err.offset is not None:
+                    err.offset += offset
+                if errors is None:
+                    raise
+                errors.append(err)
+            except kurt.UnknownBlock, err:
+                if errors is None:
+                    raise
+                errors.append(err)
+        return scripts
+
+    def throw(self, msg, hint=None, expected=None):
+        if expected:
+            repr_expected = map(repr, expected)
+            hint = "Expected %s" % (repr_expected[0]
+                                    if len(repr_expected) == 1
+                                    else "one of " + ", ".join(repr_expected))
+
+        if hint:
+            msg += ". " + hint
+
+        if self._lines is None: # errors may be caught and retried
+            self._lines = NEWLINE_PAT.split(self.program)
+        line = self._lines[self.lineno - 1]
+        err = SyntaxError(msg, ('<string>', self.lineno, self.position, line))
+        err.expected = expected
+        raise err
 
-    context = scriptable
-    next = tokenize(program).next
-    token = next()
-    result = expression()
-    if not isinstance(token, end_token):
-        throw("Expected end of input")
-    if isinstance(result, kurt.Block):
-        result = [result]
-    if not isinstance(result, list):
-        throw("Result does not evaluate to a block")
-    return kurt.Script(result)
 
+def parse(program, scriptable):
+    """Parse the text and return a :class:`Script`.
+
+    A new :class:`Parser` is used for each call, so this is thread-safe.
 
-def throw(msg, hint=None, expected=None):
-    global remain
+    """
+    return Parser(scriptable).parse(program)
 
-    if expected:
-        repr_expected = map(repr, expected)
-        hint = "Expected %s" % (repr_expected[0] if len(repr_expected) == 1
-                                else "one of " + ", ".join(repr_expected))
+def parse_many(texts, scriptable):
+    """Parse many texts in the context of the same :class:`Scriptable`.
 
-    if hint:
-        msg += ". " + hint
+    Each text may contain several scripts separated by blank lines, as for
+    :attr:`Parser.parse_scripts`. A single :class:`Parser` is used, so the
+    tokenizer and menu options are only set up once.
 
-    line = NEWLINE_PAT.split(p_input)[lineno - 1]
-    offset = len(p_input) - len(remain) #- len(token.value)
-    err = SyntaxError(msg, ('<string>', lineno, offset, line))
-    err.expected = expected
-    raise err
+    Returns a list with a ``(scripts, errors)`` pair for each text: the
+    :class:`Scripts <Script>` which parsed, and the :py:class:`SyntaxError` or
+    :class:`UnknownBlock` for each script which didn't. An error in one script
+    doesn't stop the others from being parsed.
 
+    """
+    parser = Parser(scriptable)
+    results = []
+    for text in texts:
+        errors = []
+        scripts = parser.parse_scripts(text, errors)
+        results.append((scripts, errors))
+    return results
@@ -4,6 +4,11 @@ import unittest
 from kurt import kurt
 
 from tests.corpus import *
+from tests.blocks import *
+from tests.batch import *
+from tests.scratch14 import *
+from tests.scratch20 import *
+from tests.text import *
 
 SELF_PATH = os.path.dirname(os.path.abspath(__file__))
 
@@ -28,3 +33,27 @@ class TestPickle(unittest.TestCase):
         self.assertEqual(original._pil_image.size, restored._pil_image.size)
         self.assertEqual(original._pil_image.tobytes(),
                          restored._pil_image.tobytes())
+
+
+class TestMediaEquality(unittest.TestCase):
+    def test_image(self):
+        red = kurt.Image.new((8, 8), (255, 0, 0))
+        self.assertEqual(red, kurt.Image.new((8, 8), (255, 0, 0)))
+        self.assertNotEqual(red, kurt.Image.new((8, 8), (0, 0, 255)))
+        self.assertEqual(len(set([red, kurt.Image.new((8, 8), (255, 0, 0))])),
+                         1)
+
+        png = red.convert("PNG")
+        self.assertEqual(png, kurt.Image(png.contents, "PNG"))
+        self.assertNotEqual(png, red)
+
+    def test_waveform(self):
+        self.assertEqual(kurt.Waveform("RIFF1"), kurt.Waveform("RIFF1"))
+        self.assertNotEqual(kurt.Waveform("RIFF1"), kurt.Waveform("RIFF2"))
+
+    def test_placeholders(self):
+        image = kurt.Image.placeholder((8, 8))
+        self.assertEqual(image, image)
+        self.assertNotEqual(image, kurt.Image.placeholder((8, 8)))
+        self.assertNotEqual(kurt.Waveform.placeholder(),
+                            kurt.Waveform.placeholder())
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+from kurt import kurt
+import kurt.batch
+
+SELF_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestBatchConvert(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def convert(self, paths):
+        plugin = kurt.plugin.Kurt.get_plugin("scratch20")
+        jobs = [kurt.batch.Job(path,
+                    kurt.batch.output_path(path, root, plugin, self.folder),
+                    plugin.name)
+                for (path, root) in kurt.batch.find_projects(paths, [".sb"])]
+        return list(kurt.batch.convert_files(jobs, processes=1))
+
+    def test_convert(self):
+        path = os.path.join(SELF_PATH, 'game.sb')
+        [result] = self.convert([path])
+        self.assertEqual(result["status"], "ok")
+        self.assertEqual(result["output"],
+                         os.path.join(self.folder, 'game.sb2'))
+        kurt.Project.load(result["output"])
+
+        [result] = self.convert([path])
+        self.assertEqual(result["status"], "skipped")
+
+    def test_folder(self):
+        results = self.convert([os.path.join(SELF_PATH, 'v14')])
+        self.assertTrue(results)
+        for result in results:
+            self.assertTrue(result["path"].endswith(".sb"))
+            self.assertTrue(result["output"].startswith(self.folder))
+
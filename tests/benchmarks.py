@@ -0,0 +1,568 @@
+# Copyright (C) 2012 Tim Radvan
+#
+# This file is part of Kurt.
+#
+# Kurt is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Kurt is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with Kurt. If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing benchmarks. These aren't run as part of the test suite.
+
+Usage: python -m tests.benchmarks [name ...]
+
+Runs all the benchmarks if no names are given.
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from kurt import kurt
+
+SELF_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+def best_time(f, repeat=3):
+    """Return the fastest of ``repeat`` runs of ``f()`` in seconds."""
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+def peak_memory(f):
+    """Run ``f()`` in a child process, and return how many kilobytes its
+    peak memory use grew by. Linux only."""
+    import resource
+    pid = os.fork()
+    if not pid:
+        f()
+        os._exit(0)
+    (pid, status, usage) = os.wait4(pid, 0)
+    return usage.ru_maxrss - resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def report(label, seconds=None):
+    if seconds is None:
+        print "  %s" % label
+    else:
+        print "  %-40s %9.3fs" % (label, seconds)
+
+
+
+#-- Fixtures --#
+
+def make_script(length):
+    blocks = [kurt.Block("whenGreenFlag")]
+    while len(blocks) < length:
+        blocks.append(kurt.Block("say:duration:elapsed:from:",
+            kurt.Block("+", kurt.Block("xpos"), len(blocks)), 2))
+    return kurt.Script(blocks, pos=(10, 10))
+
+def make_project(block_count, script_length=100):
+    """Return a Project containing roughly ``block_count`` blocks."""
+    project = kurt.Project()
+    sprite = kurt.Sprite(project, "Sprite1")
+    project.sprites.append(sprite)
+
+    blocks_per_script = script_length * 3 - 2
+    for i in xrange(max(1, block_count // blocks_per_script)):
+        sprite.scripts.append(make_script(script_length))
+    return project
+
+def make_costume_image(size=(480, 360)):
+    """Return an RGBA PIL image with both flat areas and noisy detail."""
+    import PIL.Image
+    import PIL.ImageDraw
+    (width, height) = size
+    image = PIL.Image.new("RGBA", size, (255, 255, 255, 0))
+    draw = PIL.ImageDraw.Draw(image)
+    for i in xrange(0, width, 40):
+        draw.ellipse((i, i // 2, i + 120, i // 2 + 90),
+                     fill=(i % 256, 100, 200, 255))
+    noise = PIL.Image.frombytes("RGBA", (width // 4, height // 4),
+                                os.urandom(width * height // 4))
+    image.paste(noise, (width // 2, height // 2))
+    return image
+
+def argb_bytes(pil_image):
+    rgba = bytearray(pil_image.convert("RGBA").tobytes())
+    argb = bytearray(len(rgba))
+    argb[0::4] = rgba[3::4]
+    argb[1::4] = rgba[0::4]
+    argb[2::4] = rgba[1::4]
+    argb[3::4] = rgba[2::4]
+    return str(argb)
+
+def make_rle_bitmap(pil_image):
+    """Return the image run-length encoded as 32-bit words."""
+    from kurt.scratch14.fixed_objects import Bitmap
+    return Bitmap(argb_bytes(pil_image)).compress().value
+
+SCRIPT_LINES = [
+    "say [Hello!] for 2 secs",
+    "move (10) steps",
+    "turn cw (15) degrees",
+    "set [x] to (join [a] (x position))",
+    "change [y] by 1",
+    "broadcast [go]",
+    "wait (0.5) secs",
+    "go to x: (1) y: (2)",
+    "point in direction 90",
+    "next costume",
+]
+
+def make_script_text(length):
+    """Return block plugin text for a script with ``length`` lines, for a
+    sprite with the variables ``x`` and ``y``."""
+    lines = ["when gf clicked"]
+    while len(lines) < length:
+        lines.append(SCRIPT_LINES[len(lines) % len(SCRIPT_LINES)])
+    return "\n".join(lines)
+
+def make_parse_sprite():
+    project = kurt.Project()
+    sprite = kurt.Sprite(project, "Sprite1")
+    project.sprites.append(sprite)
+    sprite.variables["x"] = kurt.Variable()
+    sprite.variables["y"] = kurt.Variable()
+    return sprite
+
+class TemporaryFolder(object):
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix="kurt-bench-")
+        return self.path
+
+    def __exit__(self, *args):
+        shutil.rmtree(self.path)
+
+
+
+#-- Benchmarks --#
+
+@benchmark
+def load_50k_blocks():
+    """Load a project with 50,000 blocks."""
+    project = make_project(50000)
+    with TemporaryFolder() as folder:
+        for format in ("scratch20", "scratch14"):
+            project.convert(format)
+            path = project.save(os.path.join(folder, "blocks"))
+            report("load %s" % os.path.basename(path),
+                   best_time(lambda: kurt.Project.load(path), repeat=1))
+
+@benchmark
+def decode_100k_blocks():
+    """Decode the blocks of a .sb2 with 100,000 blocks."""
+    from kurt.scratch20 import ZipReader
+    project = make_project(100000)
+    project.convert("scratch20")
+    with TemporaryFolder() as folder:
+        path = project.save(os.path.join(folder, "blocks"))
+        with open(path, "rb") as fp:
+            reader = ZipReader(fp, media=False)
+        scripts = [s for child in reader.json['children']
+                     for s in child.get('scripts', [])]
+        report("load_script x %i" % len(scripts), best_time(lambda:
+            [reader.load_script(s) for s in scripts]))
+        report("load", best_time(lambda: kurt.Project.load(path), repeat=1))
+
+@benchmark
+def walk_blocks():
+    """Traverse deep and shallow block trees."""
+    from kurt.scratch14.heights import block_height
+    from kurt.scratch20 import get_blocks_by_id
+    deep = kurt.Block("broadcast:", "message")
+    for i in xrange(300): # stay under the default recursion limit
+        deep = kurt.Block("repeat", 2, [deep])
+    shallow = make_project(100000)
+    scripts = shallow.sprites[0].scripts
+    deep_project = kurt.Project()
+    deep_project.stage.scripts.append(kurt.Script([deep]))
+
+    report("get_blocks_by_id, depth 300 x 100", best_time(lambda:
+        [list(get_blocks_by_id(deep)) for i in xrange(100)]))
+    report("get_blocks_by_id, shallow 100k blocks", best_time(lambda:
+        [list(get_blocks_by_id(s)) for s in scripts]))
+    report("get_broadcasts, depth 300 x 100", best_time(lambda:
+        [list(deep_project.get_broadcasts()) for i in xrange(100)]))
+    report("get_broadcasts, shallow 100k blocks", best_time(lambda:
+        list(shallow.get_broadcasts())))
+    report("block_height, depth 300 x 10", best_time(lambda:
+        [block_height(deep) for i in xrange(10)]))
+    report("block_height, shallow 100k blocks", best_time(lambda:
+        [block_height(b) for s in scripts for b in s]))
+    report("convert, depth 300 x 10", best_time(lambda:
+        [deep_project.convert(("scratch14", "scratch20")[i % 2])
+         for i in xrange(10)]))
+    report("convert, shallow 100k blocks", best_time(lambda:
+        shallow.convert("scratch20")))
+
+@benchmark
+def parse_in_big_project():
+    """Parse a short script in a project with 100,000 blocks."""
+    project = make_project(100000)
+    sprite = project.sprites[0]
+    text = "\n".join(["when gf clicked"] +
+                     ["broadcast (join [message] (%i))" % i
+                      for i in xrange(20)])
+    report("parse 20 broadcasts", best_time(lambda: sprite.parse(text)))
+
+@benchmark
+def tokenize_1000_lines():
+    """Tokenize and parse a 1,000-line script."""
+    import kurt.text
+    sprite = make_parse_sprite()
+    text = make_script_text(1000)
+    report("tokenize", best_time(lambda:
+        list(kurt.text.tokenize(text, sprite))))
+    report("parse", best_time(lambda: sprite.parse(text), repeat=1))
+
+@benchmark
+def parse_many_scripts():
+    """Parse 200 ten-line scripts, one at a time and as a batch."""
+    import kurt.text
+    sprite = make_parse_sprite()
+    texts = [make_script_text(10)] * 200
+    report("parse each", best_time(lambda:
+        [kurt.text.parse(text, sprite) for text in texts]))
+    report("parse_many", best_time(lambda:
+        kurt.text.parse_many(texts, sprite)))
+
+@benchmark
+def block_lookup():
+    """Resolve each block command and text using BlockType.get."""
+    commands = [pbt.command for bt in kurt.plugin.Kurt.blocks
+                            for pbt in bt.conversions]
+    report("%i commands x 100" % len(commands), best_time(lambda:
+        [kurt.BlockType.get(c) for i in xrange(100) for c in commands]))
+    report("%i commands by text x 10" % len(commands), best_time(lambda:
+        [kurt.plugin.Kurt.blocks_by_text(c) for i in xrange(10)
+                                            for c in commands]))
+
+
+@benchmark
+def rle_decode():
+    """Decode a run-length encoded 480x360 costume."""
+    from kurt.scratch14.fixed_objects import Bitmap
+    bytes_ = make_rle_bitmap(make_costume_image())
+    report("construct (%i bytes)" % len(bytes_), best_time(lambda:
+        Bitmap._from_byte_array_construct(bytes_), repeat=1))
+    report("Bitmap.from_byte_array", best_time(lambda:
+        Bitmap.from_byte_array(bytes_)))
+
+
+@benchmark
+def rle_encode():
+    """Encode a 480x360 costume, and save a project with costumes to .sb."""
+    from kurt.scratch14.fixed_objects import Bitmap
+    pil_image = make_costume_image()
+    bitmap = Bitmap(argb_bytes(pil_image))
+    report("Bitmap.compress", best_time(bitmap.compress))
+    report("%i -> %i bytes" % (len(bitmap.value),
+                               len(bitmap.compress().value)))
+
+    project = kurt.Project()
+    sprite = kurt.Sprite(project, "Sprite1")
+    project.sprites.append(sprite)
+    for i in xrange(10):
+        sprite.costumes.append(kurt.Costume("costume%i" % i,
+                                            kurt.Image(make_costume_image())))
+    project.convert("scratch14")
+    with TemporaryFolder() as folder:
+        path = os.path.join(folder, "costumes.sb")
+        report("save 10 costumes", best_time(lambda: project.save(path)))
+        report("%i bytes" % os.path.getsize(path))
+        report("load 10 costumes", best_time(lambda: [c.image.pil_image
+            for c in kurt.Project.load(path).sprites[0].costumes]))
+
+
+@benchmark
+def form_from_string():
+    """Convert a 480x360 RGBA costume to a 32-bit Form."""
+    from kurt.scratch14.fixed_objects import Form
+    rgba = make_costume_image().tobytes()
+    report("Form.from_string", best_time(lambda:
+        Form.from_string(480, 360, rgba)))
+
+
+@benchmark
+def sound_swap():
+    """Convert 4MB of samples between .sb and WAV byte order."""
+    from kurt.scratch14 import swap_byte_pairs, swap_byte_pairs_inplace
+    from kurt.scratch14.fixed_objects import SoundBuffer
+    samples = os.urandom(4 << 20)
+    report("swap_byte_pairs", best_time(lambda: swap_byte_pairs(samples)))
+    buf = bytearray(samples)
+    report("swap_byte_pairs_inplace", best_time(lambda:
+        swap_byte_pairs_inplace(buf)))
+
+    plugin = kurt.plugin.Kurt.get_plugin("scratch14")
+    serializer = plugin.serializer_cls(plugin)
+    v14_sound = serializer.UserObject("SoundMedia", name="noise",
+        originalSound=serializer.UserObject("SampledSound",
+            samples=SoundBuffer(samples), samplesSize=len(samples) // 2,
+            originalSamplingRate=22050))
+    report("load_sound", best_time(lambda: serializer.load_sound(v14_sound)))
+    sound = serializer.load_sound(v14_sound)
+    report("save_sound", best_time(lambda: serializer.save_sound(sound)))
+
+
+@benchmark
+def load_sb_scripts():
+    """Load a .sb with 10 costumes, touching only the scripts."""
+    project = make_project(1000)
+    for i in xrange(10):
+        project.sprites[0].costumes.append(kurt.Costume("costume%i" % i,
+                                           kurt.Image(make_costume_image())))
+    project.convert("scratch14")
+    with TemporaryFolder() as folder:
+        path = project.save(os.path.join(folder, "costumes"))
+        report("load", best_time(lambda: kurt.Project.load(path)))
+        report("load and decode costumes", best_time(lambda: [
+            c.image.pil_image
+            for c in kurt.Project.load(path).sprites[0].costumes]))
+
+@benchmark
+def load_without_media():
+    """Load every project in the test corpus, with and without media."""
+    import glob
+    paths = sorted(glob.glob(os.path.join(SELF_PATH, "*.sb")) +
+                   glob.glob(os.path.join(SELF_PATH, "v14", "*.sb")) +
+                   glob.glob(os.path.join(SELF_PATH, "v20", "*.sb2")))
+    report("%i files, media=True" % len(paths), best_time(lambda:
+        [kurt.Project.load(path) for path in paths]))
+    report("%i files, media=False" % len(paths), best_time(lambda:
+        [kurt.Project.load(path, media=False) for path in paths]))
+
+@benchmark
+def obj_table_codec():
+    """Parse and build a .sb with 50k blocks, construct vs hand-written."""
+    from kurt.scratch14.objtable import scratch_file
+    from kurt.scratch14.objtable import parse_scratch_file, build_scratch_file
+    from kurt import StringIO
+    project = make_project(50000)
+    project.convert("scratch14")
+    fp = StringIO()
+    project._save(fp)
+    data = fp.getvalue()
+    v14_project = parse_scratch_file(StringIO(data))
+    report("%i objects" % (len(v14_project.info) + len(v14_project.stage)))
+    report("parse (construct)", best_time(lambda:
+        scratch_file.parse_stream(StringIO(data))))
+    report("parse", best_time(lambda: parse_scratch_file(StringIO(data))))
+    report("build (construct)", best_time(lambda:
+        scratch_file.build_stream(v14_project, StringIO())))
+    report("build", best_time(lambda:
+        build_scratch_file(v14_project, StringIO())))
+
+@benchmark
+def read_sprite_names():
+    """Read the sprite names from a .sb with 10 costumes, vs loading it."""
+    from kurt.scratch14.objtable import ScratchFileReader
+    project = make_project(1000)
+    for i in xrange(10):
+        project.sprites[0].costumes.append(kurt.Costume("costume%i" % i,
+                                           kurt.Image(make_costume_image())))
+    project.convert("scratch14")
+    plugin = kurt.plugin.Kurt.get_plugin("scratch14")
+    def read_names():
+        with open(path, "rb") as fp:
+            stage = ScratchFileReader(fp, plugin).stage
+        return [stage.resolve(stage.resolve(ref).name)
+                for ref in stage.resolve(stage.root.sprites)]
+    with TemporaryFolder() as folder:
+        path = project.save(os.path.join(folder, "costumes"))
+        report("load", best_time(lambda: kurt.Project.load(path)))
+        report("sprite names", best_time(read_names))
+
+def make_waveform(sample_count):
+    import wave
+    from kurt import StringIO
+    f = StringIO()
+    w = wave.open(f, "w")
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(22050)
+    w.writeframes(os.urandom(sample_count * 2))
+    w.close()
+    return kurt.Waveform(f.getvalue())
+
+@benchmark
+def load_sb2_media():
+    """Load a 50MB .sb2 with 50 sounds, then read one sound."""
+    project = make_project(1000)
+    for i in xrange(50):
+        project.sprites[0].sounds.append(kurt.Sound("sound%i" % i,
+                                                    make_waveform(500000)))
+    project.convert("scratch20")
+    with TemporaryFolder() as folder:
+        path = project.save(os.path.join(folder, "sounds"))
+        report("%i bytes" % os.path.getsize(path))
+        report("load", best_time(lambda: kurt.Project.load(path)))
+        loaded = kurt.Project.load(path)
+        waveforms = [s.waveform for s in loaded.sprites[0].sounds]
+        report("%i bytes of sound data in memory" % sum(len(w._contents or "")
+                                                        for w in waveforms))
+        report("read one sound", best_time(lambda:
+            waveforms[0]._source.read()))
+        report("load and save", best_time(lambda:
+            kurt.Project.load(path).save(os.path.join(folder, "copy.sb2"))))
+
+@benchmark
+def save_from_template():
+    """Convert a 10-costume .sb to .sb2, with and without an AssetStore."""
+    from kurt.scratch20 import AssetStore
+    project = kurt.Project()
+    sprite = kurt.Sprite(project, "Sprite1")
+    project.sprites.append(sprite)
+    for i in xrange(10):
+        sprite.costumes.append(kurt.Costume("costume%i" % i,
+                                            kurt.Image(make_costume_image())))
+    project.convert("scratch14")
+    plugin = kurt.plugin.Kurt.get_plugin("scratch20")
+    with TemporaryFolder() as folder:
+        template = project.save(os.path.join(folder, "template"))
+        def convert():
+            project = kurt.Project.load(template)
+            project.convert("scratch20")
+            project.save(os.path.join(folder, "output"))
+        report("without store", best_time(convert))
+        plugin.asset_store = AssetStore(os.path.join(folder, "store"))
+        try:
+            convert()
+            report("with store", best_time(convert))
+        finally:
+            plugin.asset_store = None
+
+@benchmark
+def encode_images():
+    """Save a .sb2 with 40 new 480x360 costumes, using 1 and N threads."""
+    import multiprocessing
+    pil_images = [make_costume_image() for i in xrange(40)]
+    def make_project():
+        project = kurt.Project()
+        sprite = kurt.Sprite(project, "Sprite1")
+        project.sprites.append(sprite)
+        for (i, pil_image) in enumerate(pil_images):
+            sprite.costumes.append(kurt.Costume("costume%i" % i,
+                                                kurt.Image(pil_image)))
+        project.convert("scratch20")
+        return project
+
+    with TemporaryFolder() as folder:
+        path = os.path.join(folder, "costumes.sb2")
+        for threads in (1, None):
+            report("%i threads" % (threads or multiprocessing.cpu_count()),
+                   best_time(lambda: make_project().save(path,
+                                                    encode_threads=threads)))
+
+@benchmark
+def compress_levels():
+    """Save the test corpus as .sb2 at each compression level."""
+    import glob
+    from kurt import StringIO
+    paths = sorted(glob.glob(os.path.join(SELF_PATH, "*.sb")) +
+                   glob.glob(os.path.join(SELF_PATH, "v14", "*.sb")) +
+                   glob.glob(os.path.join(SELF_PATH, "v20", "*.sb2")))
+    projects = []
+    for path in paths:
+        # Load from memory, so that media isn't copied through compressed.
+        format = "scratch20" if path.endswith(".sb2") else "scratch14"
+        with open(path, "rb") as f:
+            project = kurt.Project.load(StringIO(f.read()), format)
+        try:
+            project.convert("scratch20")
+            project._save(StringIO())
+        except Exception: # some of the corpus can't be saved as .sb2 yet
+            continue
+        for costume in [c for s in [project.stage] + project.sprites
+                          for c in s.costumes]:
+            costume.image = costume.image.convert("SVG", "JPEG", "PNG")
+            costume.image.md5
+        projects.append(project)
+
+    report("%i projects:" % len(projects))
+    report("%-28s %9s %9s" % ("", "bytes", "seconds"))
+    for (level, store_media) in [(-1, False), (-1, True), (1, False),
+                                 (1, True), (9, False), (0, False)]:
+        sizes = []
+        def save():
+            del sizes[:]
+            for project in projects:
+                fp = StringIO()
+                project._save(fp, compress_level=level,
+                              store_compressed_media=store_media)
+                sizes.append(len(fp.getvalue()))
+        seconds = best_time(save)
+        label = "level %i%s" % (level, ", media stored" if store_media else "")
+        report("%-28s %9i %9.3f" % (label, sum(sizes), seconds))
+
+@benchmark
+def save_sb2_memory():
+    """Peak memory while saving 50,000 blocks in 10 sprites to .sb2."""
+    from kurt import StringIO
+    project = kurt.Project()
+    for i in xrange(10):
+        sprite = kurt.Sprite(project, "Sprite%i" % i)
+        for j in xrange(5000 // 298):
+            sprite.scripts.append(make_script(100))
+        project.sprites.append(sprite)
+        project.actors.append(sprite)
+    project.convert("scratch20")
+    report("%i KB" % peak_memory(lambda: project._save(StringIO())))
+
+@benchmark
+def json_backends():
+    """Share of the largest .sb2's load time spent parsing its JSON."""
+    import glob
+    import zipfile
+    from kurt.scratch20 import JSONBackend
+    path = max(glob.glob(os.path.join(SELF_PATH, "v20", "*.sb2")),
+               key=os.path.getsize)
+    data = zipfile.ZipFile(path).read("project.json")
+    report("%s (%i bytes of JSON)" % (os.path.basename(path), len(data)))
+
+    plugin = kurt.plugin.Kurt.get_plugin("scratch20")
+    for name in ("ujson", "simplejson", "json"):
+        backend = JSONBackend([name])
+        if backend.loader.__name__ != name:
+            report("%s: not installed" % name)
+            continue
+        plugin.json_backend = backend
+        try:
+            parse = best_time(lambda: [backend.loads(data)
+                                       for i in xrange(100)]) / 100
+            load = best_time(lambda: [kurt.Project.load(path)
+                                      for i in xrange(100)]) / 100
+        finally:
+            plugin.json_backend = JSONBackend()
+        report("%s: parse %.2fms of %.2fms load (%i%%)" % (name,
+               parse * 1000, load * 1000, 100 * parse / load))
+
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or BENCHMARKS.keys()
+    for name in names:
+        print "%s: %s" % (name, BENCHMARKS[name].__doc__)
+        BENCHMARKS[name]()
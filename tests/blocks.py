@@ -0,0 +1,81 @@
+import unittest
+from kurt import kurt
+from kurt.plugin import Kurt
+
+
+class TestBlockLookup(unittest.TestCase):
+    def test_by_command(self):
+        for block_type in Kurt.blocks:
+            for pbt in block_type.conversions:
+                self.assertTrue(
+                    Kurt.block_by_command(pbt.command).has_command(
+                        pbt.command))
+        self.assertEqual(Kurt.block_by_command("notABlock:"), None)
+
+    def test_by_text(self):
+        block_type = kurt.BlockType.get("say:duration:elapsed:from:")
+        self.assertEqual(Kurt.blocks_by_text("Say %s for %s secs"),
+                         [block_type])
+        self.assertTrue(kurt.BlockType.get("sayforsecs") is block_type)
+
+    def test_unknown(self):
+        self.assertRaises(kurt.UnknownBlock, kurt.BlockType.get, "notABlock:")
+
+
+
+class TestWalk(unittest.TestCase):
+    def setUp(self):
+        self.inner = kurt.Block("xpos")
+        self.say = kurt.Block("say:", kurt.Block("join", self.inner, "!"))
+        self.move = kurt.Block("forward:", 10)
+        self.repeat = kurt.Block("repeat", 3, [self.say, self.move])
+        self.script = kurt.Script([kurt.Block("whenGreenFlag"), self.repeat])
+
+    def test_pre_order(self):
+        blocks = [b for (b, parent, index) in self.script.walk()]
+        self.assertEqual([b.type.convert().command for b in blocks],
+            ["whenGreenFlag", "doRepeat", "say:", "concatenate:with:",
+             "xpos", "forward:"])
+
+    def test_post_order(self):
+        blocks = [b for (b, parent, index) in
+                  self.repeat.walk(post_order=True)]
+        self.assertEqual([b.type.convert().command for b in blocks],
+            ["xpos", "concatenate:with:", "say:", "forward:", "doRepeat"])
+
+    def test_parents(self):
+        walk = list(self.repeat.walk())
+        self.assertEqual(walk[0], (self.repeat, None, None))
+        self.assertEqual(walk[1], (self.say, self.repeat, 1))
+        self.assertEqual(walk[3][1:], (self.say.args[0], 0))
+        self.assertEqual(walk[-1], (self.move, self.repeat, 1))
+
+    def test_deep(self):
+        block = kurt.Block("broadcast:", "message")
+        for i in xrange(5000):
+            block = kurt.Block("repeat", 2, [block])
+        sprite = kurt.Sprite(kurt.Project(), "Sprite1")
+        sprite.scripts.append(kurt.Script([block]))
+        sprite.project.sprites.append(sprite)
+        self.assertEqual(list(sprite.project.get_broadcasts()), ["message"])
+        sprite.project.convert("scratch14")
+        self.assertEqual(sprite.scripts[0][0].type.convert().command,
+                         "doRepeat")
+
+        block = kurt.Block("xpos")
+        for i in xrange(5000):
+            block = kurt.Block("join", block, "x")
+        self.assertEqual(len(list(block.walk(post_order=True))), 5001)
+
+    def test_block_height_depth(self):
+        from kurt.scratch14 import heights
+        block = kurt.Block("broadcast:", "message")
+        for i in xrange(heights._RECURSION_DEPTH + 50):
+            block = kurt.Block("repeat", 2, [block])
+        height = heights.block_height(block)
+        limit = heights._RECURSION_DEPTH
+        heights._RECURSION_DEPTH = 1000
+        try:
+            self.assertEqual(heights.block_height(block), height)
+        finally:
+            heights._RECURSION_DEPTH = limit
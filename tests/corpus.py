@@ -19,6 +19,45 @@ class CorpusTests(unittest.TestCase):
 
 
 
+class TestLoadWithoutMedia(unittest.TestCase):
+    def _test_file(self, path):
+        project = kurt.Project.load(path)
+        bare = kurt.Project.load(path, media=False)
+        self.assertEqual(len(bare.sprites), len(project.sprites))
+        for (s1, s2) in zip([project.stage] + project.sprites,
+                            [bare.stage] + bare.sprites):
+            self.assertEqual(len(s1.scripts), len(s2.scripts))
+            self.assertEqual([c.name for c in s1.costumes],
+                             [c.name for c in s2.costumes])
+            self.assertEqual([s.name for s in s1.sounds],
+                             [s.name for s in s2.sounds])
+            for sound in s2.sounds:
+                self.assertRaises(kurt.MediaNotLoaded,
+                                  lambda: sound.waveform.contents)
+            for costume in s2.costumes:
+                self.assertRaises(kurt.MediaNotLoaded,
+                                  lambda: costume.image.pil_image)
+        return (project, bare)
+
+    def test_scratch14(self):
+        (project, bare) = self._test_file(os.path.join(SELF_PATH, "game.sb"))
+        pickle.loads(pickle.dumps(bare, pickle.HIGHEST_PROTOCOL))
+        for (c1, c2) in zip(project.stage.costumes, bare.stage.costumes):
+            self.assertEqual(c1.image.size, c2.image.size)
+        for (s1, s2) in zip(project.sprites[0].sounds,
+                            bare.sprites[0].sounds):
+            self.assertEqual(s1.waveform.rate, s2.waveform.rate)
+            self.assertEqual(s1.waveform.sample_count,
+                             s2.waveform.sample_count)
+
+    def test_scratch20(self):
+        for path in glob.glob(os.path.join(SELF_PATH, "v20", "*.sb2")):
+            (project, bare) = self._test_file(path)
+            for (c1, c2) in zip(project.stage.costumes, bare.stage.costumes):
+                self.assertEqual(c1.image.format, c2.image.format)
+
+
+
 # Define tests declaratively
 
 def create_test(path):
@@ -0,0 +1,295 @@
+import glob
+import os
+import struct
+import unittest
+
+import PIL.Image
+
+from kurt import kurt, StringIO
+from kurt.scratch14.objtable import scratch_file
+from kurt.scratch14.objtable import parse_scratch_file, build_scratch_file
+from kurt.scratch14.objtable import obj_table, parse_obj_table, build_obj_table
+from kurt.scratch14.objtable import ObjTableReader, ScratchFileReader
+from kurt.scratch14.objtable import decode_obj_table
+from kurt.scratch14.inline_objects import Ref
+from kurt.scratch14.fixed_objects import Bitmap, ByteArray, Form
+from kurt.scratch14.fixed_objects import encode_run_length
+from kurt.scratch14 import swap_byte_pairs, swap_byte_pairs_inplace
+
+SELF_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def encode_int(value):
+    if value <= 223:
+        return chr(value)
+    elif value <= 7935:
+        return chr(224 + value // 256) + chr(value % 256)
+    else:
+        return "\xff" + struct.pack(">I", value)
+
+def corpus_paths():
+    paths = glob.glob(os.path.join(SELF_PATH, '*.sb'))
+    paths += glob.glob(os.path.join(SELF_PATH, 'v14', '*.sb'))
+    return sorted(paths)
+
+def corpus_byte_arrays():
+    """Yield the compressed bits of each Form in the test .sb files."""
+    for path in corpus_paths():
+        with open(path, "rb") as fp:
+            v14_project = scratch_file.parse_stream(fp)
+        for table in (v14_project.info, v14_project.stage):
+            for entry in table:
+                if isinstance(entry, Form):
+                    bits = table[entry.bits.index - 1]
+                    if isinstance(bits, ByteArray):
+                        yield bits.value
+
+
+class TestObjTable(unittest.TestCase):
+    """Check the hand-written codec against the construct definitions."""
+
+    def test_parse_corpus(self):
+        for path in corpus_paths():
+            with open(path, "rb") as fp:
+                expected = scratch_file.parse_stream(fp)
+            with open(path, "rb") as fp:
+                v14_project = parse_scratch_file(fp)
+            self.assertEqual(v14_project.info, expected.info)
+            self.assertEqual(v14_project.stage, expected.stage)
+
+    def test_build_corpus(self):
+        for path in corpus_paths():
+            with open(path, "rb") as fp:
+                v14_project = scratch_file.parse_stream(fp)
+            fp = StringIO()
+            build_scratch_file(v14_project, fp)
+            self.assertEqual(fp.getvalue(), scratch_file.build(v14_project))
+
+    def test_fields(self):
+        values = [None, True, False, 0, -1, 32767, -32768, 32768, -2 ** 31,
+                  2 ** 31, 2 ** 64 + 5, 0.5, Ref(1), Ref(70000)]
+        entries = [values, {Ref(4): Ref(1)}, u"\u00e9t\u00e9", "text"]
+        data = obj_table.build(entries)
+        self.assertEqual(build_obj_table(entries), data)
+        self.assertEqual(parse_obj_table(data), (obj_table.parse(data),
+                                                 len(data)))
+
+    def test_negative_large_integer(self):
+        data = ("ObjS\x01Stch\x01" "\x00\x00\x00\x01"
+                "\x14\x00\x00\x00\x01" "\x07\x00\x06\x00\x00\x00\x00\x00\x01")
+        self.assertEqual(build_obj_table([[-2 ** 40]]), data)
+        self.assertEqual(parse_obj_table(data), ([[-2 ** 40]], len(data)))
+
+    def test_truncated(self):
+        data = obj_table.build(["some text"])
+        self.assertRaises(ValueError, parse_obj_table, data[:-1])
+        self.assertRaises(ValueError, parse_obj_table, "ObjS\x01Stch\x02")
+
+
+class TestObjTableReader(unittest.TestCase):
+    def test_corpus(self):
+        for path in corpus_paths():
+            with open(path, "rb") as fp:
+                v14_project = parse_scratch_file(fp)
+            with open(path, "rb") as fp:
+                reader = ScratchFileReader(fp)
+            self.assertEqual(list(reader.info), v14_project.info)
+            self.assertEqual(list(reader.stage), v14_project.stage)
+            self.assertEqual(reader.stage.end, len(reader.data))
+
+    def test_sprite_names(self):
+        plugin = kurt.plugin.Kurt.get_plugin("scratch14")
+        path = os.path.join(SELF_PATH, "game.sb")
+        with open(path, "rb") as fp:
+            reader = ScratchFileReader(fp, plugin)
+        self.assertEqual(reader.info.decode()["author"],
+                         kurt.Project.load(path).author)
+        self.assertEqual(reader._stage, None)
+
+        stage = reader.stage
+        names = [stage.resolve(stage.resolve(ref).name)
+                 for ref in stage.resolve(stage.root.sprites)]
+        self.assertEqual(names, [sprite.name for sprite
+                                 in kurt.Project.load(path).sprites])
+        self.assertTrue(len(stage._entries) < len(stage) / 2)
+
+    def test_decode(self):
+        plugin = kurt.plugin.Kurt.get_plugin("scratch14")
+        entries = [{Ref(2): Ref(3)}, "text", [1, Ref(2)]]
+        data = obj_table.build(entries)
+        reader = ObjTableReader(data, plugin=plugin)
+        self.assertEqual(len(reader), 3)
+        self.assertEqual(reader.root, {Ref(2): Ref(3)})
+        self.assertEqual(reader.resolve(reader.root[Ref(2)]), [1, Ref(2)])
+        self.assertEqual(reader.decode(), decode_obj_table(
+            obj_table.parse(data), plugin))
+        self.assertEqual(reader[2], [1, Ref(2)])
+
+    def test_bad_index(self):
+        reader = ObjTableReader(obj_table.build(["text", [1, Ref(1)]]))
+        self.assertRaises(IndexError, lambda: reader[2])
+        self.assertRaises(IndexError, lambda: reader[-1])
+        self.assertEqual(reader.resolve(Ref(1)), "text")
+        self.assertRaises(ValueError, reader.resolve, Ref(0))
+        self.assertRaises(ValueError, reader.resolve, Ref(3))
+
+    def test_truncated(self):
+        data = obj_table.build(["some text", [1, 2]])
+        self.assertRaises(ValueError, ObjTableReader, data[:-1])
+        self.assertRaises(ValueError, ObjTableReader, data[:-4])
+
+        reader = ObjTableReader(data)
+        reader.data = data[:reader.offsets[1] + 5]
+        self.assertRaises(ValueError, lambda: reader[1])
+        reader.data = data[:reader.offsets[1] + 6]
+        self.assertRaises(ValueError, lambda: reader[1])
+
+    def test_close(self):
+        with open(os.path.join(SELF_PATH, "game.sb"), "rb") as fp:
+            with ScratchFileReader(fp) as reader:
+                self.assertTrue(reader.info.root)
+        self.assertRaises(ValueError, lambda: reader.data[0])
+
+
+class TestBitmap(unittest.TestCase):
+    def assertDecodesSame(self, bytes_):
+        self.assertEqual(Bitmap.from_byte_array(bytes_).value,
+                         Bitmap._from_byte_array_construct(bytes_).value)
+
+    def test_corpus(self):
+        count = 0
+        for bytes_ in corpus_byte_arrays():
+            self.assertDecodesSame(bytes_)
+            count += 1
+        self.assertTrue(count)
+
+    def test_data_codes(self):
+        runs = (encode_int(3 * 4 + 0) +
+                encode_int(2 * 4 + 1) + "\x7f" +
+                encode_int(300 * 4 + 2) + "\x01\x02\x03\x04" +
+                encode_int(2 * 4 + 3) + "abcdefgh" +
+                encode_int(5000 * 4 + 2) + "\xff\x00\xff\x00")
+        bytes_ = encode_int(5307) + runs
+        self.assertDecodesSame(bytes_)
+        self.assertEqual(Bitmap.from_byte_array(bytes_).value,
+            "\x00" * 12 + "\x7f" * 8 + "\x01\x02\x03\x04" * 300 +
+            "abcdefgh" + "\xff\x00\xff\x00" * 5000)
+
+    def test_truncated(self):
+        bytes_ = encode_int(3) + encode_int(1 * 4 + 2) + "\x01\x02\x03\x04"
+        self.assertDecodesSame(bytes_ + encode_int(2 * 4 + 3) + "abcd")
+
+    def test_compress(self):
+        words = ("\x00\x00\x00\x00" * 3 + "\x7f\x7f\x7f\x7f" * 2 +
+                 "\x01\x02\x03\x04" * 300 + "abcdefgh" + "ijkl" * 5000 +
+                 "mnop")
+        bytes_ = encode_run_length(words)
+        self.assertEqual(bytes_, encode_int(5308) +
+            encode_int(3 * 4 + 0) +
+            encode_int(2 * 4 + 1) + "\x7f" +
+            encode_int(300 * 4 + 2) + "\x01\x02\x03\x04" +
+            encode_int(2 * 4 + 3) + "abcdefgh" +
+            encode_int(5000 * 4 + 2) + "ijkl" +
+            encode_int(1 * 4 + 3) + "mnop")
+        self.assertDecodesSame(bytes_)
+        self.assertEqual(Bitmap(words).compress(), ByteArray(bytes_))
+
+    def test_compress_corpus(self):
+        for bytes_ in corpus_byte_arrays():
+            bitmap = Bitmap.from_byte_array(bytes_)
+            compressed = bitmap.compress()
+            self.assertTrue(len(compressed.value) <= len(bytes_))
+            self.assertEqual(Bitmap.from_byte_array(compressed.value), bitmap)
+
+    def test_save_compressed(self):
+        project = kurt.Project()
+        project.stage.costumes.append(kurt.Costume("stage",
+            kurt.Image.new((480, 360), (10, 20, 30))))
+        project.convert("scratch14")
+        serializer = project._plugin.serializer_cls(project._plugin)
+        v14_image = serializer.save_image(project.stage.costumes[0])
+        self.assertTrue(isinstance(v14_image.form.bits, ByteArray))
+        self.assertTrue(len(v14_image.form.bits.value) < 100)
+
+        v14_image.form.built()
+        pil_image = v14_image.form.to_array()
+        self.assertEqual(pil_image.size, (480, 360))
+        self.assertEqual(pil_image.getpixel((0, 0)), (10, 20, 30, 255))
+
+
+class TestForm(unittest.TestCase):
+    def test_from_string(self):
+        rgba = "\x01\x02\x03\x04\x05\x06\x07\x08"
+        form = Form.from_string(2, 1, rgba)
+        self.assertEqual(form.depth, 32)
+        self.assertEqual(form.bits.value, "\x04\x01\x02\x03\x08\x05\x06\x07")
+        self.assertEqual(form.to_array().tobytes(), rgba)
+
+    def test_depth_16(self):
+        # 3x2 pixels, rows padded to a whole word.
+        pixels = ("\x7c\x00" "\x03\xe0" "\x00\x00" "\xff\xff"
+                  "\x00\x1f" "\x00\x01" "\x00\x00" "\xff\xff")
+        form = Form(width=3, height=2, depth=16, bits=Bitmap(pixels))
+        pil_image = form.to_array()
+        self.assertEqual(pil_image.size, (3, 2))
+        self.assertEqual(list(pil_image.getdata()), [
+            (255, 0, 0, 255), (0, 255, 0, 255), (0, 0, 0, 0),
+            (0, 0, 255, 255), (0, 0, 8, 255), (0, 0, 0, 0),
+        ])
+
+
+class TestLazyImage(unittest.TestCase):
+    def test_load_is_lazy(self):
+        project = kurt.Project.load(os.path.join(SELF_PATH, "game.sb"))
+        costumes = [c for s in [project.stage] + project.sprites
+                      for c in s.costumes if c.image._decode]
+        self.assertTrue(costumes)
+        for costume in costumes:
+            size = costume.image.size
+            self.assertTrue(costume.image._decode)
+            self.assertEqual(costume.image.format, None)
+            self.assertEqual(costume.image.pil_image.size, size)
+            self.assertEqual(costume.image._decode, None)
+
+    def test_deferred(self):
+        calls = []
+        def decode():
+            calls.append(1)
+            return PIL.Image.new("RGBA", (4, 3))
+        image = kurt.Image.deferred(decode, (4, 3))
+        self.assertEqual(image.size, (4, 3))
+        self.assertEqual(calls, [])
+        self.assertTrue(image.convert("PNG").contents.startswith("\x89PNG"))
+        image.pil_image
+        self.assertEqual(calls, [1])
+
+
+class TestSound(unittest.TestCase):
+    def test_swap_byte_pairs(self):
+        self.assertEqual(swap_byte_pairs(""), "")
+        self.assertEqual(swap_byte_pairs("abcd"), "badc")
+        self.assertEqual(swap_byte_pairs("abcde"), "badce")
+        data = bytearray("abcde")
+        swap_byte_pairs_inplace(data)
+        self.assertEqual(data, bytearray("badce"))
+
+    def test_round_trip(self):
+        import wave
+        from kurt import StringIO
+        samples = "".join(chr(i % 256) for i in xrange(2000))
+        f = StringIO()
+        w = wave.open(f, "w")
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(22050)
+        w.writeframes(samples)
+        w.close()
+        sound = kurt.Sound("beep", kurt.Waveform(f.getvalue()))
+
+        plugin = kurt.plugin.Kurt.get_plugin("scratch14")
+        serializer = plugin.serializer_cls(plugin)
+        v14_sound = serializer.save_sound(sound)
+        self.assertEqual(v14_sound.originalSound.samples.value,
+                         swap_byte_pairs(samples))
+        loaded = serializer.load_sound(v14_sound)
+        self.assertEqual(loaded.waveform._wave.readframes(1000), samples)
@@ -0,0 +1,303 @@
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import zlib
+from kurt import kurt
+from kurt.scratch20 import JSONBackend, ZipMember
+
+SELF_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestZipReader(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "default.sb2")
+        shutil.copy(os.path.join(SELF_PATH, "v20", "default.sb2"), self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_lazy_media(self):
+        project = kurt.Project.load(self.path)
+        image = project.sprites[0].costumes[0].image
+        waveform = project.sprites[0].sounds[0].waveform
+        self.assertEqual(image._contents, None)
+        self.assertTrue(isinstance(image._source, ZipMember))
+        self.assertEqual(waveform._contents, None)
+        self.assertTrue(isinstance(waveform._source, ZipMember))
+
+        self.assertTrue("<svg" in image.contents)
+        self.assertTrue(waveform.contents.startswith("RIFF"))
+        self.assertEqual(project.stage.costumes[0].image.size, (480, 360))
+
+    def test_md5(self):
+        import hashlib
+        for media in (False, True):
+            project = kurt.Project.load(self.path, media=media)
+            image = project.sprites[0].costumes[0].image
+            waveform = project.sprites[0].sounds[0].waveform
+            self.assertEqual(len(image._md5), 32)
+            self.assertEqual(len(waveform._md5), 32)
+        self.assertEqual(image._contents, None)
+        self.assertEqual(image.md5, hashlib.md5(image.contents).hexdigest())
+        self.assertEqual(waveform.md5,
+                         hashlib.md5(waveform.contents).hexdigest())
+
+        again = kurt.Project.load(self.path, media=False)
+        self.assertEqual(again.sprites[0].costumes[0].image, image)
+        self.assertEqual(again.sprites[0].sounds[0].waveform, waveform)
+        self.assertNotEqual(again.sprites[0].costumes[1].image, image)
+
+    def test_from_file_object(self):
+        from kurt import StringIO
+        with open(self.path, "rb") as f:
+            fp = StringIO(f.read())
+        project = kurt.Project.load(fp, "scratch20")
+        image = project.sprites[0].costumes[0].image
+        self.assertEqual(image._source, None)
+        self.assertTrue("<svg" in image.contents)
+
+    def test_save_over_original(self):
+        project = kurt.Project.load(self.path)
+        contents = [c.image.contents for c in project.sprites[0].costumes]
+
+        project = kurt.Project.load(self.path)
+        project.save()
+        self.assertEqual(os.listdir(self.folder), ["default.sb2"])
+        self.assertEqual([c.image.contents
+                          for c in project.sprites[0].costumes], contents)
+        project = kurt.Project.load(self.path)
+        self.assertEqual([c.image.contents
+                          for c in project.sprites[0].costumes], contents)
+
+    def test_source_changed(self):
+        project = kurt.Project.load(self.path)
+        image = project.sprites[0].costumes[0].image
+        open(self.path, "wb").close()
+        self.assertRaises(IOError, lambda: image.contents)
+
+    def test_save_detaches_media(self):
+        project = kurt.Project.load(self.path)
+        image = project.sprites[0].costumes[0].image
+        project.save()
+        self.assertEqual(image._source, None)
+        self.assertTrue("<svg" in image.contents)
+
+    def test_pickle(self):
+        project = kurt.Project.load(self.path)
+        waveform = project.sprites[0].sounds[0].waveform
+        restored = pickle.loads(pickle.dumps(waveform))
+        self.assertEqual(restored._source, None)
+        self.assertEqual(restored.contents, waveform.contents)
+
+    def test_load_block(self):
+        from kurt.scratch20 import ZipReader
+        with open(self.path, "rb") as fp:
+            reader = ZipReader(fp)
+        block = reader.load_block(["doRepeat", "3", [["forward:", "1.5"]]])
+        self.assertEqual(block, kurt.Block("repeat", 3,
+                                           [kurt.Block("forward:", 1.5)]))
+        self.assertEqual(block.comment, u"")
+        block = reader.load_block(["say:duration:elapsed:from:", "Hi"])
+        self.assertEqual(block.args, ["Hi", 2])
+        self.assertEqual(block.args, kurt.Block("sayforsecs", "Hi").args)
+
+
+class TestZipWriter(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_passthrough(self):
+        import zipfile
+        original = os.path.join(SELF_PATH, "v20", "default.sb2")
+        project = kurt.Project.load(original)
+        project.sprites[0].scripts = []
+        path = project.save(os.path.join(self.folder, "copy.sb2"))
+        for costume in project.sprites[0].costumes:
+            self.assertEqual(costume.image._contents, None) # not decompressed
+
+        old = zipfile.ZipFile(original)
+        new = zipfile.ZipFile(path)
+        self.assertEqual(new.testzip(), None)
+        old_json = json.loads(old.read("project.json"))
+        new_json = json.loads(new.read("project.json"))
+        for (old_sd, new_sd) in [(old_json, new_json),
+                                 (old_json["children"][0],
+                                  new_json["children"][0])]:
+            for (old_cd, new_cd) in zip(old_sd["costumes"],
+                                        new_sd["costumes"]):
+                self.assertEqual(old_cd["baseLayerMD5"],
+                                 new_cd["baseLayerMD5"])
+                (_, ext) = os.path.splitext(old_cd["baseLayerMD5"])
+                old_info = old.getinfo("%i%s" % (old_cd["baseLayerID"], ext))
+                new_info = new.getinfo("%i%s" % (new_cd["baseLayerID"], ext))
+                self.assertEqual(old_info.CRC, new_info.CRC)
+                self.assertEqual(old_info.compress_size,
+                                 new_info.compress_size)
+
+    def make_project(self):
+        project = kurt.Project()
+        for name in ("Sprite1", "Sprite2"):
+            sprite = kurt.Sprite(project, name)
+            sprite.costumes.append(kurt.Costume(name + " costume",
+                kurt.Image.new((32, 32), (255, 0, 0))))
+            project.sprites.append(sprite)
+            project.actors.append(sprite)
+        project.convert("scratch20")
+        return project
+
+    def test_dedup(self):
+        import zipfile
+        path = self.make_project().save(os.path.join(self.folder, "a.sb2"))
+        zf = zipfile.ZipFile(path)
+        # One for the blank backdrop, one shared by both sprites.
+        self.assertEqual(sorted(zf.namelist()),
+                         ["0.png", "1.png", "project.json"])
+        project = kurt.Project.load(path)
+        self.assertEqual([s.costumes[0].name for s in project.sprites],
+                         ["Sprite1 costume", "Sprite2 costume"])
+
+    def test_asset_store(self):
+        from kurt.scratch20 import AssetStore
+        store_path = os.path.join(self.folder, "store")
+        plugin = kurt.plugin.Kurt.get_plugin("scratch20")
+        plugin.asset_store = AssetStore(store_path)
+        try:
+            a = self.make_project().save(os.path.join(self.folder, "a.sb2"))
+            stored = sorted(os.listdir(store_path))
+            b = self.make_project().save(os.path.join(self.folder, "b.sb2"))
+            self.assertEqual(sorted(os.listdir(store_path)), stored)
+        finally:
+            plugin.asset_store = None
+        self.assertEqual(len(stored), 3) # two images, and the pixels folder
+        (image_a, image_b) = [kurt.Project.load(path).sprites[0].costumes[0]
+                              .image for path in (a, b)]
+        self.assertEqual(image_a.contents, image_b.contents)
+        self.assertEqual(image_a.pil_image.getpixel((0, 0)), (255, 0, 0))
+
+    def test_encode_threads(self):
+        import zipfile
+        project = kurt.Project()
+        sprite = kurt.Sprite(project, "Sprite1")
+        project.sprites.append(sprite)
+        for i in xrange(8):
+            sprite.costumes.append(kurt.Costume("costume%i" % i,
+                kurt.Image.new((16, 16), (i * 30, 0, 0))))
+        sprite.costumes.append(sprite.costumes[0].copy())
+        project.convert("scratch20")
+
+        archives = []
+        for threads in (1, 4):
+            path = project.save(os.path.join(self.folder, "%i.sb2" % threads),
+                                encode_threads=threads)
+            zf = zipfile.ZipFile(path)
+            archives.append([(name, zf.read(name))
+                             for name in sorted(zf.namelist())])
+        self.assertEqual(archives[0], archives[1])
+        self.assertEqual(len(archives[0]), 10) # 9 images with the backdrop
+
+    def test_compression(self):
+        import zipfile
+        from kurt import StringIO
+        with open(os.path.join(SELF_PATH, "v20", "default.sb2"), "rb") as f:
+            fp = StringIO(f.read()) # so it isn't copied through as-is
+        project = kurt.Project.load(fp, "scratch20")
+
+        path = project.save(os.path.join(self.folder, "stored.sb2"),
+                            store_compressed_media=True)
+        zf = zipfile.ZipFile(path)
+        self.assertEqual(zf.testzip(), None)
+        types = dict((os.path.splitext(zi.filename)[1], zi.compress_type)
+                     for zi in zf.infolist())
+        self.assertEqual(types, {".png": zipfile.ZIP_STORED,
+                                 ".svg": zipfile.ZIP_DEFLATED,
+                                 ".wav": zipfile.ZIP_DEFLATED,
+                                 ".json": zipfile.ZIP_DEFLATED})
+
+        path = project.save(os.path.join(self.folder, "level0.sb2"),
+                            compress_level=0)
+        zf = zipfile.ZipFile(path)
+        self.assertEqual(zf.testzip(), None)
+        self.assertEqual(set(zi.compress_type for zi in zf.infolist()),
+                         set([zipfile.ZIP_STORED]))
+        kurt.Project.load(path)
+
+    def test_project_json(self):
+        import zipfile
+        project = kurt.Project.load(os.path.join(SELF_PATH, "game.sb"))
+        project.convert("scratch20")
+        for level in (0, zlib.Z_DEFAULT_COMPRESSION):
+            path = project.save(os.path.join(self.folder, "game.sb2"),
+                                compress_level=level)
+            zf = zipfile.ZipFile(path)
+            self.assertEqual(zf.testzip(), None)
+            pd = json.loads(zf.read("project.json"))
+            self.assertEqual([cd["objName"] for cd in pd["children"]
+                              if "objName" in cd],
+                             [sprite.name for sprite in project.sprites])
+            self.assertEqual(pd["info"]["spriteCount"], len(project.sprites))
+
+        pd = project.save(os.path.join(self.folder, "game.sb2"), debug=True)
+        self.assertEqual([cd["objName"] for cd in pd["children"]
+                          if "objName" in cd],
+                         [sprite.name for sprite in project.sprites])
+
+    def test_writestr_fallback(self):
+        import zipfile
+        from kurt import StringIO
+        from kurt.scratch20 import ZipWriter
+        project = kurt.Project.load(os.path.join(SELF_PATH, "game.sb"))
+        project.convert("scratch20")
+        fp = StringIO()
+        zw = ZipWriter(fp)
+        zw._start_member = lambda zi, zip64=False, seek=False: False
+        try:
+            zw.write_project(project)
+        finally:
+            zw.finish()
+        zf = zipfile.ZipFile(StringIO(fp.getvalue()))
+        self.assertEqual(zf.testzip(), None)
+        pd = json.loads(zf.read("project.json"))
+        self.assertEqual(pd["info"]["spriteCount"], len(project.sprites))
+
+
+class TestJSONBackend(unittest.TestCase):
+    DATA = '{"name": "Sprite1", "x": 0.1, "n": 12345678901234567890, ' \
+           '"t": "\\u00e9"}'
+
+    def check_backend(self, name, loader, dumper):
+        try:
+            __import__(name)
+        except ImportError:
+            self.skipTest("%s is not installed" % name)
+        backend = JSONBackend((name, "json"))
+        self.assertEqual(backend.loader.__name__, loader)
+        self.assertEqual(backend.dumper.__name__, dumper)
+
+        result = backend.loads(self.DATA)
+        self.assertEqual(result, json.loads(self.DATA))
+        self.assertEqual(map(type, result.keys()), [unicode] * 4)
+        self.assertTrue(isinstance(result["name"], unicode))
+        self.assertTrue(isinstance(result["x"], float))
+        self.assertEqual(backend.encoder().encode(result),
+                         json.dumps(result))
+
+    def test_ujson(self):
+        self.check_backend("ujson", "ujson", "json")
+
+    def test_simplejson(self):
+        self.check_backend("simplejson", "simplejson", "simplejson")
+
+    def test_json(self):
+        self.check_backend("json", "json", "json")
+
+    def test_fallback(self):
+        backend = JSONBackend(("nonexistent", "json"))
+        self.assertEqual(backend.loader, json)
+        self.assertTrue(backend.loads('{"x": NaN}')["x"] != 0)
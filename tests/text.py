@@ -0,0 +1,221 @@
+import re
+import sys
+import threading
+import unittest
+from kurt import kurt
+import kurt.text
+
+
+class TestInsertOptions(unittest.TestCase):
+    def setUp(self):
+        self.project = kurt.Project()
+        self.sprite = kurt.Sprite(self.project, "Sprite1")
+        self.project.sprites.append(self.sprite)
+        self.insert = kurt.Insert("readonly-menu", "broadcast")
+
+    def test_broadcasts(self):
+        self.sprite.parse("when gf clicked\nbroadcast [go]")
+        self.assertEqual(self.insert.options(self.sprite), ["go"])
+
+        self.sprite.parse("broadcast [stop]")
+        self.assertEqual(sorted(self.insert.options(self.sprite)),
+                         ["go", "stop"])
+
+    def test_scripts_edited(self):
+        self.assertEqual(self.insert.options(self.sprite), [])
+        block = kurt.Block("broadcast:", "go")
+        self.project.stage.scripts.append(kurt.Script([block]))
+        self.assertEqual(self.insert.options(self.sprite), ["go"])
+        block.args[0] = "stop"
+        self.assertEqual(self.insert.options(self.sprite), ["stop"])
+
+    def test_parser_options(self):
+        self.project.stage.scripts.append(kurt.Script([
+            kurt.Block("broadcast:", "go")]))
+        parser = kurt.text.Parser(self.sprite)
+        self.assertEqual(parser.options(self.insert), frozenset(["go"]))
+        self.assertTrue(parser.options(self.insert) is
+                        parser.options(self.insert))
+
+
+class TestTokenize(unittest.TestCase):
+    def setUp(self):
+        self.project = kurt.Project()
+        self.sprite = kurt.Sprite(self.project, "Sprite1")
+        self.project.sprites.append(self.sprite)
+        self.sprite.variables["x"] = kurt.Variable()
+
+    def test_trie_regex(self):
+        pattern = re.compile("(%s)$" % kurt.text.trie_regex(
+            ["say", "say hi", "set", "s.t", ""]))
+        for word in ["say", "say hi", "set", "s.t"]:
+            self.assertEqual(pattern.match(word).group(1), word)
+        self.assertEqual(pattern.match("sat"), None)
+        self.assertEqual(re.match(kurt.text.trie_regex([]), "x"), None)
+
+    def test_longest_token(self):
+        self.sprite.parse("when gf clicked\nturn cw (15) degrees\n"
+                          "set [x] to (x position)")
+        self.assertEqual(self.sprite.scripts[0], kurt.Script([
+            kurt.Block("whenGreenFlag"),
+            kurt.Block("turnRight:", 15),
+            kurt.Block("setVar:to:", "x", kurt.Block("xpos")),
+        ]))
+
+    def test_unknown_token(self):
+        try:
+            self.sprite.parse("move (10) steps\nmove $ steps")
+        except SyntaxError, err:
+            self.assertEqual(err.lineno, 2)
+            self.assertEqual(err.offset, len("move (10) steps\nmove "))
+        else:
+            self.fail("no SyntaxError")
+
+
+class TestParserThreads(unittest.TestCase):
+    SCRIPTS = [
+        "when gf clicked\nsay [Hello!] for 2 secs\nmove (10) steps",
+        "when gf clicked\nset [x] to (x position)\nturn cw (15) degrees",
+        "when gf clicked\nchange [x] by 1\nbroadcast [go]\nnext costume",
+        "when gf clicked\nwait (0.5) secs\ngo to x: (1) y: (2)",
+    ]
+
+    def make_sprite(self, project, name):
+        sprite = kurt.Sprite(project, name)
+        project.sprites.append(sprite)
+        sprite.variables["x"] = kurt.Variable()
+        return sprite
+
+    def test_concurrent_parse(self):
+        project = kurt.Project()
+        expected = [kurt.text.parse(text, self.make_sprite(project, "a"))
+                    for text in self.SCRIPTS]
+
+        sprites = [self.make_sprite(project, "Sprite%i" % i)
+                   for i in xrange(len(self.SCRIPTS))]
+        results = dict((sprite.name, []) for sprite in sprites)
+        errors = []
+        def work(sprite, i):
+            try:
+                for j in xrange(3):
+                    # Parse on our own sprite and the shared stage at once.
+                    text = self.SCRIPTS[(i + j) % len(self.SCRIPTS)]
+                    results[sprite.name].append(kurt.text.parse(text, sprite))
+                    project.stage.parse("broadcast [go]")
+            except Exception, err:
+                errors.append(err)
+
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(5) # switch threads often
+        try:
+            threads = [threading.Thread(target=work, args=(sprite, i))
+                       for (i, sprite) in enumerate(sprites)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+
+        self.assertEqual(errors, [])
+        for (i, sprite) in enumerate(sprites):
+            self.assertEqual(results[sprite.name], [
+                expected[(i + j) % len(self.SCRIPTS)] for j in xrange(3)])
+        self.assertEqual(len(project.stage.scripts), 3 * len(sprites))
+
+
+class TestBlockTrie(unittest.TestCase):
+    def scan(self, parts, exact=False):
+        """The blocks matching the parts, found by checking every block."""
+        matches = []
+        for block in kurt.text.all_the_blocks():
+            if len(parts) > len(block.parts):
+                continue
+            if exact and len(parts) != len(block.parts):
+                continue
+            for (part, block_part) in zip(parts, block.parts):
+                if not kurt.text.match_part(part, block_part):
+                    break
+            else:
+                matches.append(block)
+        return matches
+
+    def test_matches_scan(self):
+        arg = kurt.text.string("x")
+        for block in kurt.text.all_the_blocks():
+            parts = [arg if isinstance(p, kurt.Insert) else p.strip()
+                     for p in block.parts]
+            for i in xrange(1, len(parts) + 1):
+                self.assertEqual(
+                    list(kurt.text.blocks_starting_with(parts[:i])),
+                    self.scan(parts[:i]))
+            self.assertEqual(kurt.text.blocks_by_parts(parts),
+                             self.scan(parts, exact=True))
+
+    def test_no_match(self):
+        self.assertEqual(list(kurt.text.blocks_starting_with(["say", 3])), [])
+        self.assertEqual(kurt.text.blocks_by_parts(["notABlock"]), [])
+
+
+class TestMultipleScripts(unittest.TestCase):
+    def setUp(self):
+        self.project = kurt.Project()
+        self.sprite = kurt.Sprite(self.project, "Sprite1")
+        self.project.sprites.append(self.sprite)
+
+    def test_split_scripts(self):
+        program = "\nsay [a]\nsay [b]\n\n  \nmove (10) steps\n\n"
+        self.assertEqual(list(kurt.text.split_scripts(program)), [
+            ("\nsay [a]\nsay [b]", 1, 0),
+            ("move (10) steps", 6, program.index("move")),
+        ])
+
+    def test_parse(self):
+        self.sprite.parse("when gf clicked\nsay [a]\n\nwhen gf clicked\n"
+                          "say [b]")
+        self.assertEqual(self.sprite.scripts, [
+            kurt.Script([kurt.Block("whenGreenFlag"),
+                         kurt.Block("say:", "a")]),
+            kurt.Script([kurt.Block("whenGreenFlag"),
+                         kurt.Block("say:", "b")]),
+        ])
+
+    def test_error_line(self):
+        program = "say [a]\n\nsay [b]\nmove $ steps"
+        try:
+            self.sprite.parse(program)
+        except SyntaxError, err:
+            self.assertEqual(err.lineno, 4)
+            self.assertEqual(err.offset, program.index("$"))
+        else:
+            self.fail("no SyntaxError")
+        self.assertEqual(self.sprite.scripts, [])
+
+    def test_parse_many(self):
+        results = kurt.text.parse_many([
+            "say [a]",
+            "move $ steps",
+            "say [b]\n\nsay [c]",
+            "",
+            "say (",
+            "(((",
+            "end",
+            "say [a]\n\nmove $ steps\n\nsay [c]",
+        ], self.sprite)
+        self.assertEqual(results[0],
+                         ([kurt.Script([kurt.Block("say:", "a")])], []))
+        self.assertEqual(results[1][0], [])
+        self.assertEqual(map(type, results[1][1]), [SyntaxError])
+        self.assertEqual(results[2], ([kurt.Script([kurt.Block("say:", "b")]),
+                                       kurt.Script([kurt.Block("say:", "c")])],
+                                      []))
+        self.assertEqual(results[3], ([], []))
+        for (scripts, errors) in results[4:7]:
+            self.assertEqual(scripts, [])
+            self.assertEqual(map(type, errors), [SyntaxError])
+
+        (scripts, errors) = results[7]
+        self.assertEqual(scripts, [kurt.Script([kurt.Block("say:", "a")]),
+                                   kurt.Script([kurt.Block("say:", "c")])])
+        self.assertEqual(map(type, errors), [SyntaxError])
+        self.assertEqual(errors[0].lineno, 3)